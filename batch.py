@@ -0,0 +1,171 @@
+import datetime
+import argparse
+import glob
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from gepetto import bot_factory, gpt
+from gepetto.cache import cache_stats
+from gepetto.hedging import hedge_stats
+from gepetto.limiter import scheduler_stats, set_rate_limit
+from gepetto.limiter import LimitedBot
+from helpers import create_output_directory, get_requirements, percentile
+from docker_stuff import ContainerPool, build_distro_container, wait_for_teardowns
+from main import DISTROS, get_abort_checks, run_pipeline
+from run_state import MemoStore, RunState
+from steps import use_result_cache
+
+def find_requirements_files(source):
+    if os.path.isdir(source):
+        return sorted(path for path in glob.glob(os.path.join(source, "*")) if os.path.isfile(path))
+    return sorted(glob.glob(source))
+
+def get_job_names(requirements_files):
+    # name each job by its path relative to the files' common directory, so a glob spanning several directories
+    # (specs/*/req.txt) doesn't put two jobs in one output directory.  Anything still clashing keeps its extension.
+    base = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in requirements_files])
+    relative = {path: os.path.relpath(os.path.abspath(path), base).replace(os.sep, "__") for path in requirements_files}
+    stems = [os.path.splitext(name)[0] for name in relative.values()]
+    return {path: os.path.splitext(name)[0] if stems.count(os.path.splitext(name)[0]) == 1 else name for path, name in relative.items()}
+
+def batch(source, model=gpt.Model.GPT_4_OMNI_0806.value[0], vendor="", jobs=4, llm_calls=4, container_slots=2, pool_size=0, rebuild=False, per_distro_tests=False, speculative=False, docs_mode="full", pipeline="multi", max_repairs=0, candidates=1, cache=True, refresh=False, stage_models={}, stream=False, max_output_chars=0, rate_limits={}, hedge=None, hedge_after=None, resume=False, test_cache=True):
+    requirements_files = find_requirements_files(source)
+    if not requirements_files:
+        print(f"No requirements files found in {source}. Exiting.")
+        exit(1)
+    create_output_directory()
+
+    start_time = datetime.datetime.now()
+    for vendor_name, (requests_per_minute, tokens_per_minute) in rate_limits.items():
+        set_rate_limit(vendor_name, requests_per_minute, tokens_per_minute)
+    test_results = MemoStore(".test_cache") if test_cache else None
+    use_result_cache(test_results)
+    bots = bot_factory.get_stage_bots(model=model, vendor=vendor, stage_models=stage_models, cache=cache, refresh=refresh, stream=stream, abort_checks=get_abort_checks(max_output_chars), hedge=hedge, hedge_after=hedge_after)
+    # one limit on LLM calls across every stage, whichever model it uses
+    llm_slots = threading.BoundedSemaphore(llm_calls)
+    bots = {stage: LimitedBot(bot, semaphore=llm_slots) for stage, bot in bots.items()}
+    slots = threading.BoundedSemaphore(container_slots)
+    pool = ContainerPool(size=pool_size) if pool_size > 0 else None
+    memo = MemoStore(refresh=refresh) if pipeline == "dag" else None
+    if rebuild:
+        # rebuild the images once up front rather than once per job
+        for container_type, version in DISTROS:
+            build_distro_container(container_type.lower(), version, rebuild=True)
+
+    job_names = get_job_names(requirements_files)
+    print(f"Running {len(requirements_files)} jobs ({jobs} at a time)...")
+    runs = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(run_job, requirements_file, job_names[requirements_file], bots, per_distro_tests, speculative, docs_mode, pipeline, max_repairs, candidates, pool, slots, resume, memo): requirements_file
+            for requirements_file in requirements_files
+        }
+        for future in as_completed(futures):
+            requirements_file = futures[future]
+            run = future.result()
+            runs[requirements_file] = run
+            status = f"saved to {run['filename']}" if run["passed"] else "FAILED"
+            print(f"[{len(runs)}/{len(requirements_files)}] {requirements_file}: {status} ({round(run['elapsed'], 2)} seconds, ${round(run['cost'], 5)})")
+
+    if pool is not None:
+        pool.shutdown()
+    wait_for_teardowns()
+
+    elapsed_time = (datetime.datetime.now() - start_time).total_seconds()
+    times = [run["elapsed"] for run in runs.values()]
+    failures = {requirements_file: run for requirements_file, run in runs.items() if not run["passed"]}
+    print("\n\n")
+    print(f"Successes: {len(runs) - len(failures)}")
+    print(f"Failures: {len(failures)}")
+    for requirements_file, run in sorted(failures.items()):
+        print(f"  {requirements_file}: {run['error'].splitlines()[0] if run['error'] else 'unknown error'}")
+    print(f"Total cost: ${round(sum(run['cost'] for run in runs.values()), 5)}")
+    repairs = sum(run["repairs"] for run in runs.values())
+    if repairs:
+        print(f"Repairs: {repairs} (cost: ${round(sum(run['repair_cost'] for run in runs.values()), 5)})")
+    print(f"Time per job: p50 {round(percentile(times, 50), 2)} seconds | p95 {round(percentile(times, 95), 2)} seconds")
+    print(f"Total time: {round(elapsed_time, 2)} seconds")
+    print("Stages:")
+    for stage in bot_factory.STAGES:
+        tallies = [run["stages"][stage] for run in runs.values()]
+        calls = sum(tally["calls"] for tally in tallies)
+        if calls:
+            cost = sum(tally["cost"] for tally in tallies)
+            seconds = sum(tally["seconds"] for tally in tallies)
+            cached_tokens = sum(tally["cached_tokens"] for tally in tallies)
+            print(f"  {stage} ({bots[stage].model}): {calls} calls, ${round(cost, 5)}, {round(seconds / calls, 2)} seconds per call, {round(cached_tokens)} cached tokens")
+            streamed = sum(tally["streamed"] for tally in tallies)
+            if streamed:
+                first_token_seconds = sum(tally["first_token_seconds"] for tally in tallies)
+                aborted = sum(tally["aborted"] for tally in tallies)
+                print(f"    first token after {round(first_token_seconds / streamed, 2)} seconds on average, {aborted} aborted")
+    if cache:
+        print(f"LLM cache: {cache_stats(bots.values())}")
+    hedging = hedge_stats(bots.values())
+    if hedging:
+        print(f"Hedging: {hedging}")
+    for vendor_name, stats in scheduler_stats().items():
+        print(f"Rate limits ({vendor_name}): {stats}")
+    if memo is not None:
+        print(f"Pipeline memo: {memo.stats()}")
+    if test_results is not None:
+        print(f"Test cache: {test_results.stats()}")
+    return runs
+
+def run_job(requirements_file, job_name, bots, per_distro_tests, speculative, docs_mode, pipeline, max_repairs, candidates, pool, slots, resume=False, memo=None):
+    # every job gets its own directory under outputs/ for the module, its log and its saved stages
+    output_dir = os.path.join("outputs", job_name)
+    create_output_directory(output_dir)
+    requirements = get_requirements(requirements_file)
+    state = RunState(os.path.join(output_dir, "state"))
+    if not resume:
+        state.clear()
+    return run_pipeline(
+        requirements,
+        bots,
+        log_file=os.path.join(output_dir, "log.md"),
+        output_dir=output_dir,
+        per_distro_tests=per_distro_tests,
+        speculative=speculative,
+        docs_mode=docs_mode,
+        pipeline=pipeline,
+        max_repairs=max_repairs,
+        candidates=candidates,
+        pool=pool,
+        container_slots=slots,
+        quiet=True,
+        state=state,
+        memo=memo,
+    )
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument("source", type=str, help="A directory of requirements files, or a glob matching them")
+    argp.add_argument("--model", type=str, default=gpt.Model.GPT_4_OMNI_0806.value[0], help="The LLM model to use")
+    argp.add_argument("--vendor", type=str, default="openai", help="The LLM vendor to use (not needed for openai/anthropic models)")
+    argp.add_argument("--jobs", type=int, default=4, help="How many requirements files to work on at once")
+    argp.add_argument("--llm-calls", type=int, default=4, help="How many LLM calls can be in flight at once")
+    argp.add_argument("--container-slots", type=int, default=2, help="How many jobs can have test containers running at once")
+    argp.add_argument("--pool-size", type=int, default=0, help="Keep this many containers per image warmed up and waiting")
+    argp.add_argument("--rebuild", action="store_true", help="Rebuild the Docker containers fresh")
+    argp.add_argument("--per-distro-tests", action="store_true", help="Write a separate TestInfra script for each distro")
+    argp.add_argument("--speculative", action="store_true", help="Lint and apply each module while it is being documented")
+    argp.add_argument("--docs-mode", type=str, default="full", choices=["full", "blocks"], help="Have the LLM rewrite each module with documentation, or just write doc blocks to splice in")
+    argp.add_argument("--pipeline", type=str, default="multi", choices=["multi", "single", "dag"], help="Use a separate LLM call for each step, try to do them all in one call, or run the steps as a DAG which only re-runs what has changed since last time")
+    argp.add_argument("--max-repairs", type=int, default=0, help="How many times the LLM can try to fix a module which fails its checks")
+    argp.add_argument("--candidates", type=int, default=1, help="Create this many candidate modules per job and keep the first one to pass its tests")
+    argp.add_argument("--no-cache", action="store_true", help="Don't use or store cached LLM responses")
+    argp.add_argument("--refresh", action="store_true", help="Ignore cached LLM responses, but store the new ones")
+    argp.add_argument("--no-test-cache", action="store_true", help="Always run puppet apply and the TestInfra scripts, even if the same module and test passed in the same image before")
+    argp.add_argument("--stage-model", type=str, action="append", default=[], help=f"Use a different model for one stage, as stage=model[@vendor] (stages: {', '.join(bot_factory.STAGES)}).  Can be given more than once")
+    argp.add_argument("--stage-config", type=str, default="", help="A JSON file mapping stages to models, as \"model[@vendor]\" or {\"model\": ..., \"vendor\": ...}")
+    argp.add_argument("--stream", action="store_true", help="Stream the LLM responses, timing them and cutting off any that go wrong")
+    argp.add_argument("--max-output-chars", type=int, default=0, help="When streaming, cut off any response longer than this")
+    argp.add_argument("--rate-limit", type=str, action="append", default=[], help="Hold a vendor to this many requests (and optionally tokens) a minute, as vendor=requests[/tokens].  Can be given more than once")
+    argp.add_argument("--resume", action="store_true", help="Reuse whatever each job got done last time, so only the unfinished stages run again")
+    argp.add_argument("--hedge", type=str, default="", help="If a chat is slow, race it against this model, as model[@vendor]")
+    argp.add_argument("--hedge-after", type=float, default=None, help="Seconds before a chat counts as slow (default: slower than 90%% of that stage's chats so far)")
+    args = argp.parse_args()
+    stage_models = bot_factory.get_stage_models(args.stage_model, args.stage_config, default_vendor=args.vendor)
+    batch(args.source, model=args.model, vendor=args.vendor, jobs=args.jobs, llm_calls=args.llm_calls, container_slots=args.container_slots, pool_size=args.pool_size, rebuild=args.rebuild, per_distro_tests=args.per_distro_tests, speculative=args.speculative, docs_mode=args.docs_mode, pipeline=args.pipeline, max_repairs=args.max_repairs, candidates=args.candidates, cache=not args.no_cache, refresh=args.refresh, stage_models=stage_models, stream=args.stream, max_output_chars=args.max_output_chars, rate_limits=bot_factory.get_rate_limits(args.rate_limit), hedge=bot_factory.parse_stage_model(args.hedge, args.vendor) if args.hedge else None, hedge_after=args.hedge_after, resume=args.resume, test_cache=not args.no_test_cache)
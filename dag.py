@@ -0,0 +1,101 @@
+import hashlib
+import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from gepetto.response import ChatResponse
+
+class Node():
+    """One step of a pipeline.
+
+    func is called with the outputs of the `deps` nodes, in order.  The node's key is a hash of its name,
+    `key_parts` (anything else its output depends on, eg a prompt or model name) and its dependencies' outputs,
+    so it only needs running again when one of those changes.  key_parts can be a function, for parts that are
+    slow to work out and only needed once the node is ready to run.
+    """
+    def __init__(self, name, func, deps=[], key_parts=[], memoise=True):
+        self.name = name
+        self.func = func
+        self.deps = deps
+        self.key_parts = key_parts
+        self.memoise = memoise
+
+def output_hash(value):
+    # only what a response says counts, not what it cost (which is 0 when it's reused)
+    content = value.message if isinstance(value, ChatResponse) else value
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def node_key(node, dep_outputs):
+    key_parts = node.key_parts() if callable(node.key_parts) else node.key_parts
+    key = json.dumps([node.name, key_parts, [output_hash(output) for output in dep_outputs]], sort_keys=True, default=str)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+def check_nodes(nodes):
+    # every dependency has to exist and there can't be any cycles, or the run would never finish
+    names = [node.name for node in nodes]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Node names must be unique : {names}")
+    by_name = {node.name: node for node in nodes}
+    for node in nodes:
+        for dep in node.deps:
+            if dep not in by_name:
+                raise ValueError(f"Node {node.name} depends on unknown node : {dep}")
+    done = set()
+    while len(done) < len(nodes):
+        ready = [node.name for node in nodes if node.name not in done and all(dep in done for dep in node.deps)]
+        if not ready:
+            raise ValueError(f"Nodes have a dependency cycle : {sorted(set(names) - done)}")
+        done.update(ready)
+
+def run_dag(nodes, store=None, max_workers=4, on_finish=None):
+    """Run every node once all its dependencies have, as many at a time as are ready (up to max_workers).
+
+    A node whose key is already in `store` (a MemoStore) gets its saved output rather than being run, and outputs
+    which were cut off short are never saved.  A node which raises is recorded in errors, and everything
+    downstream of it is skipped.  on_finish(node, output, reused) is called as each node finishes.
+
+    Returns:
+        dict: outputs {name: output}, errors {name: exception}, reused and ran (lists of names) and skipped
+            (a list of names which never ran because something upstream failed).
+    """
+    check_nodes(nodes)
+    result = {"outputs": {}, "errors": {}, "reused": [], "ran": [], "skipped": []}
+    remaining = list(nodes)
+    running = {}
+
+    def run_node(node):
+        dep_outputs = [result["outputs"][dep] for dep in node.deps]
+        key = node_key(node, dep_outputs)
+        if store is not None and node.memoise:
+            output = store.get(key)
+            if output is not None:
+                return output, True
+        output = node.func(*dep_outputs)
+        # half an answer isn't worth keeping for next time
+        if store is not None and node.memoise and not getattr(output, "aborted", False):
+            store.put(key, output)
+        return output, False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while remaining or running:
+            failed = set(result["errors"]) | set(result["skipped"])
+            for node in list(remaining):
+                if any(dep in failed for dep in node.deps):
+                    remaining.remove(node)
+                    result["skipped"].append(node.name)
+                elif all(dep in result["outputs"] for dep in node.deps):
+                    remaining.remove(node)
+                    running[executor.submit(run_node, node)] = node
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                try:
+                    output, reused = future.result()
+                except Exception as e:
+                    result["errors"][node.name] = e
+                    continue
+                result["outputs"][node.name] = output
+                result["reused" if reused else "ran"].append(node.name)
+                if on_finish is not None:
+                    on_finish(node, output, reused)
+    return result
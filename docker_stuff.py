@@ -1,9 +1,22 @@
 import docker
+import hashlib
 import io
-import os
 import tarfile
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from yaspin import yaspin
 
+# (container name, seconds) for every teardown, plus any teardowns still running in the background
+teardown_timings = []
+teardown_threads = []
+teardown_lock = threading.Lock()
+
+# used to boot session containers in the background
+background_executor = ThreadPoolExecutor(max_workers=8)
+
 def get_dockerfile(distro_name, version, minimal=False):
     if distro_name == 'rocky':
         return get_rocky_dockerfile(version, minimal)
@@ -82,59 +95,208 @@ ENV PATH="/opt/puppetlabs/bin:$PATH"
 CMD ["tail", "-f", "/dev/null"]
 """
 
-def copy_to_container(container, src, dst):
-    # we need to create a tarball of the source file to copy it in - dockerism
+def make_tarball(files):
+    # build a tarball in memory from {path: contents}
     tar_stream = io.BytesIO()
     with tarfile.open(fileobj=tar_stream, mode='w') as tar:
-        tar.add(src, arcname=os.path.basename(src))
+        for path, contents in files.items():
+            if isinstance(contents, str):
+                contents = contents.encode('utf-8')
+            info = tarfile.TarInfo(name=path)
+            info.size = len(contents)
+            info.mtime = int(time.time())
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(contents))
     tar_stream.seek(0)
+    return tar_stream
 
-    # copy/untar the file into the container
-    container.put_archive(os.path.dirname(dst), tar_stream)
+def put_files(container, files, dst="/tmp/"):
+    # everything goes up in a single put_archive call
+    container.put_archive(dst, make_tarball(files))
 
 def get_docker_client():
     return docker.from_env()
 
-def build_rocky_container(version=8, minimal=False, rebuild=False):
-    image_tag = f"puppet-rocky-{version}:latest"
+def get_image_tag(name, dockerfile):
+    # tag images by the content of their Dockerfile so a cached image always matches what would be built
+    return f"{name}:{hashlib.sha256(dockerfile.encode('utf-8')).hexdigest()[:12]}"
+
+def build_rocky_container(version=8, minimal=False, rebuild=False, quiet=False):
     dockerfile = get_dockerfile('rocky', version, minimal)
-    build_container(image_tag, dockerfile, rebuild)
+    image_tag = get_image_tag(f"puppet-rocky-{version}", dockerfile)
+    build_container(image_tag, dockerfile, rebuild, quiet)
     return image_tag
 
-def build_debian_container(version=12, minimal=False, rebuild=False):
-    image_tag = f"puppet-debian-{version}:latest"
+def build_debian_container(version=12, minimal=False, rebuild=False, quiet=False):
     dockerfile = get_dockerfile('debian', version, minimal)
-    build_container(image_tag, dockerfile, rebuild)
+    image_tag = get_image_tag(f"puppet-debian-{version}", dockerfile)
+    build_container(image_tag, dockerfile, rebuild, quiet)
     return image_tag
 
-def start_rocky_container(version=8, minimal=False, rebuild=False):
-    container_name = f"puppet-rocky-{version}-test-container"
-    image_tag = build_rocky_container(version=version, minimal=minimal, rebuild=rebuild)
-    container = start_container(image_tag, container_name)
-    return container
+def build_distro_container(distro_name, version, minimal=False, rebuild=False, quiet=False):
+    if distro_name == 'rocky':
+        return build_rocky_container(version=version, minimal=minimal, rebuild=rebuild, quiet=quiet)
+    if distro_name == 'debian':
+        return build_debian_container(version=version, minimal=minimal, rebuild=rebuild, quiet=quiet)
+    raise ValueError(f"No container available for distro : {distro_name}")
+
+def get_container_name(distro_name, version):
+    # every container gets a name of its own, so sessions (candidates, concurrent batch jobs) never remove each other's
+    return f"puppet-{distro_name}-{version}-test-{uuid.uuid4().hex[:8]}"
+
+class ContainerSession:
+    """A test container for one distro which can be handed from one pipeline stage to the next.
+
+    The container is started on first use and stays up until close() is called, so lint, apply
+    and testinfra can all share one booted container.
+    """
+    def __init__(self, distro_name, version, minimal=False, rebuild=False, pool=None, quiet=False):
+        self.distro_name = distro_name
+        self.version = version
+        self.minimal = minimal
+        self.rebuild = rebuild
+        self.pool = pool
+        self.quiet = quiet
+        self.image_tag = None
+        self.build_lock = threading.Lock()
+        self.container = None
+        self.starting = None
+        self.lock = threading.Lock()
+
+    def build(self):
+        # the image is built (or checked) once per session, however many containers are started from it
+        with self.build_lock:
+            if self.image_tag is None:
+                self.image_tag = build_distro_container(self.distro_name, self.version, self.minimal, self.rebuild, self.quiet)
+            return self.image_tag
+
+    def boot(self):
+        image_tag = self.build()
+        if self.pool is not None:
+            return self.pool.acquire(image_tag)
+        return start_container(image_tag, get_container_name(self.distro_name, self.version))
+
+    def image_id(self):
+        # the id of the image this session's containers start from, without starting one
+        return get_docker_client().images.get(self.build()).id
+
+    def start_in_background(self):
+        # build/check the image and boot the container while the caller gets on with something else
+        with self.lock:
+            if self.container is None and self.starting is None:
+                self.starting = background_executor.submit(self.boot)
+        return self
+
+    def start(self):
+        with self.lock:
+            if self.container is None:
+                if self.starting is not None:
+                    starting, self.starting = self.starting, None
+                    self.container = starting.result()
+                else:
+                    self.container = self.boot()
+            return self.container
+
+    def close(self, background=True):
+        with self.lock:
+            if self.starting is not None:
+                # a container still booting has to come up before it can be torn down
+                starting, self.starting = self.starting, None
+                try:
+                    self.container = starting.result()
+                except BaseException:
+                    self.container = None
+            if self.container is not None:
+                if self.pool is not None:
+                    self.pool.release(self.container)
+                elif background:
+                    tidy_up_in_background(self.container)
+                else:
+                    tidy_up(self.container)
+                self.container = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class ContainerPool:
+    """Keeps `size` pre-started containers per image so a job rarely waits for one to boot.
 
-def start_debian_container(version=12, minimal=False, rebuild=False):
-    container_name = f"puppet-debian-{version}-test-container"
-    image_tag = build_debian_container(version=version, minimal=minimal, rebuild=rebuild)
-    container = start_container(image_tag, container_name)
-    return container
+    `puppet apply` leaves a container dirty, so containers are never reused.  Taking a warm container starts its
+    replacement from the image, which is the clean snapshot every pooled container begins from, and a released
+    container is killed in the background.  If none are warm yet the caller's container is booted straight away,
+    so the pool is a buffer rather than a cap and never leaves a caller waiting on someone else's release.
+    """
+    def __init__(self, size=2):
+        self.size = size
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(size, 1) * 2)
 
-def start_container(image_tag, name):
+    def warm(self, image_tag):
+        with self.lock:
+            if image_tag in self.idle:
+                return
+            self.idle[image_tag] = queue.Queue()
+        for _ in range(self.size):
+            self.executor.submit(self.add_container, image_tag)
+
+    def start(self, image_tag):
+        return start_container(image_tag, f"{image_tag.split(':')[0]}-pool-{uuid.uuid4().hex[:8]}")
+
+    def add_container(self, image_tag):
+        try:
+            container = self.start(image_tag)
+        except Exception as e:
+            # hand the error to whoever next wants a container rather than losing it in this thread
+            self.idle[image_tag].put(e)
+            return
+        self.idle[image_tag].put(container)
+
+    def acquire(self, image_tag):
+        self.warm(image_tag)
+        try:
+            container = self.idle[image_tag].get_nowait()
+        except queue.Empty:
+            return self.start(image_tag)
+        if self.size > 0:
+            self.executor.submit(self.add_container, image_tag)
+        if isinstance(container, Exception):
+            raise RuntimeError(f"Error creating pooled container from {image_tag}: {container}")
+        return container
+
+    def release(self, container):
+        tidy_up_in_background(container)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        for containers in self.idle.values():
+            while not containers.empty():
+                container = containers.get()
+                if not isinstance(container, Exception):
+                    tidy_up_in_background(container)
+
+def start_container(image_tag, name, replace=False):
+    # only pass replace=True for a fixed name whose old container is known to be stale, as it's removed first
     client = get_docker_client()
-    remove_existing_container(name)
+    if replace:
+        remove_existing_container(name)
     try:
+        # init=True puts docker's init in as PID 1 so the container reacts to signals rather than
+        # ignoring them like a bare `tail -f /dev/null` does
         container = client.containers.run(
             image_tag,
             detach=True,
             name=name,
+            init=True,
         )
         return container
-    except docker.errors.DockerException as e:
-        print(f"Error creating container: {e}")
-        exit(1)
     except Exception as e:
-        print(f"Error creating container: {e}")
-        exit(1)
+        # raised rather than exit()ed so one run's Docker trouble fails that run, not the whole batch
+        raise RuntimeError(f"Error creating container {name} from {image_tag}: {e}") from e
 
 def remove_existing_container(container_name: str) -> bool:
     client = get_docker_client()
@@ -144,36 +306,66 @@ def remove_existing_container(container_name: str) -> bool:
     except docker.errors.DockerException as e:
         pass
 
-def build_container(image_tag, dockerfile, rebuild=False):
+def build_container(image_tag, dockerfile, rebuild=False, quiet=False):
     client = get_docker_client()
     if not rebuild:
         try:
             client.images.get(image_tag)
-            print(f"Using cached image {image_tag}")
+            if not quiet:
+                print(f"Using cached image {image_tag}")
             return image_tag
         except docker.errors.ImageNotFound:
-            print(f"Image {image_tag} not found. Building...")
-
-    with open('Dockerfile', 'w') as f:
-        f.write(dockerfile)
+            if not quiet:
+                print(f"Image {image_tag} not found. Building...")
 
+    # the build context is just the Dockerfile, rather than everything in the current directory
     try:
         client.images.build(
-            path="./",
+            fileobj=make_tarball({"Dockerfile": dockerfile}),
+            custom_context=True,
             tag=image_tag,
             rm=True,
             nocache=rebuild
         )
-    except docker.errors.BuildError as e:
-        print(e)
-        exit(1)
+    except docker.errors.DockerException as e:
+        raise RuntimeError(f"Error building image {image_tag}: {e}") from e
 
     return image_tag
 
+def get_image_digest(container):
+    # the id of the image a container was started from, which changes whenever the image is rebuilt
+    return container.attrs.get("Image") or container.image.id
+
 def exec_in_container(container, command):
     exec_result = container.exec_run(command)
     return exec_result.exit_code, exec_result.output.decode('utf-8')
 
-def tidy_up(container):
-    container.stop()
-    container.remove()
+def tidy_up(container, fast=True):
+    # nothing in a test container is worth a graceful shutdown, so by default it's killed and removed in one go
+    start_time = time.monotonic()
+    try:
+        if fast:
+            container.remove(force=True)
+        else:
+            container.stop()
+            container.remove()
+    except docker.errors.NotFound:
+        pass
+    with teardown_lock:
+        teardown_timings.append((container.name, time.monotonic() - start_time))
+
+def tidy_up_in_background(container, fast=True):
+    thread = threading.Thread(target=tidy_up, args=(container, fast))
+    thread.start()
+    with teardown_lock:
+        teardown_threads.append(thread)
+    return thread
+
+def wait_for_teardowns():
+    with teardown_lock:
+        threads = list(teardown_threads)
+        teardown_threads.clear()
+    for thread in threads:
+        thread.join()
+    with teardown_lock:
+        return list(teardown_timings)
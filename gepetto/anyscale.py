@@ -1,6 +1,8 @@
+import asyncio
 import os
 import json
-from openai import OpenAI
+from gepetto.clients import get_client, get_async_client
+from gepetto.streaming import read_openai_stream
 from gepetto.response import ChatResponse, FunctionResponse
 
 class AnyscaleModel():
@@ -15,12 +17,13 @@ class AnyscaleModel():
     def get_token_price(self, token_count, direction="output", model_engine=None):
         return (0.50 / 1000000) * token_count
 
-    async def chat(self, messages, temperature=0.7, model=None):
+    async def chat(self, messages, temperature=0.7, model=None, timeout=120):
         """Chat with the model.
 
         Args:
             messages (list): The messages to send to the model.
             temperature (float): The temperature to use for the model.
+            timeout (float): Seconds to wait for the whole request before raising asyncio.TimeoutError.
 
         Returns:
             str: The response from the model.
@@ -31,30 +34,30 @@ class AnyscaleModel():
             model = self.model
         api_key = os.getenv("ANYSCALE_API_KEY")
         api_base = os.getenv("ANYSCALE_BASE_URL")
-        client = OpenAI(api_key=api_key, base_url=api_base)
-        response = client.chat.completions.create(
+        client = get_async_client("anyscale", api_key=api_key, base_url=api_base)
+        response = await asyncio.wait_for(client.chat.completions.create(
             model=model,
             messages=messages,
             temperature=0.7,
-        )
+        ), timeout)
         # print(str(response.choices[0].message))
         tokens = response.usage.total_tokens
         cost = (0.50 / 1000000) * tokens
         message = str(response.choices[0].message.content)
         return ChatResponse(message, tokens, cost, model)
 
-    async def function_call(self, messages = [], tools = [], temperature=0.7, model=None):
+    async def function_call(self, messages = [], tools = [], temperature=0.7, model=None, timeout=120):
         if model is None:
             model = self.model
         api_key = os.getenv("ANYSCALE_API_KEY")
         api_base = os.getenv("ANYSCALE_BASE_URL")
-        client = OpenAI(api_key=api_key, base_url=api_base)
-        response = client.chat.completions.create(
+        client = get_async_client("anyscale", api_key=api_key, base_url=api_base)
+        response = await asyncio.wait_for(client.chat.completions.create(
             model=model,
             messages=messages,
             tools=tools,
             tool_choice={"type": "function", "function": {"name": tools[0]["function"]["name"]}},
-        )
+        ), timeout)
         # print(str(response.choices[0].message))
         tokens = response.usage.total_tokens
         cost = (0.50 / 1000000) * tokens
@@ -90,7 +93,7 @@ class AnyscaleModelSync():
             model = self.model
         api_key = os.getenv("ANYSCALE_API_KEY")
         api_base = os.getenv("ANYSCALE_BASE_URL")
-        client = OpenAI(api_key=api_key, base_url=api_base)
+        client = get_client("anyscale", api_key=api_key, base_url=api_base)
         response = client.chat.completions.create(
             model=model,
             messages=messages,
@@ -102,12 +105,39 @@ class AnyscaleModelSync():
         message = str(response.choices[0].message.content)
         return ChatResponse(message, tokens, cost, model)
 
+    def stream(self, messages, temperature=0.7, model=None):
+        """Chat with the model, yielding the text of the response as it arrives.
+
+        Use gepetto.streaming.chat_streaming to get a timed ChatResponse from this.
+
+        Returns:
+            dict: Once the stream is finished, the input_tokens, output_tokens, cached_tokens and cost of the request,
+                or None if the vendor didn't send them.
+        """
+        if model is None:
+            model = self.model
+        api_key = os.getenv("ANYSCALE_API_KEY")
+        api_base = os.getenv("ANYSCALE_BASE_URL")
+        client = get_client("anyscale", api_key=api_key, base_url=api_base)
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0.7,
+            stream=True,
+            extra_body={"stream_options": {"include_usage": True}},
+        )
+        usage = yield from read_openai_stream(response)
+        if usage is None:
+            return None
+        cost = (0.50 / 1000000) * usage.total_tokens
+        return {"input_tokens": usage.prompt_tokens, "output_tokens": usage.completion_tokens, "cached_tokens": 0, "cost": cost}
+
     def function_call(self, messages = [], tools = [], temperature=0.7, model=None):
         if model is None:
             model = self.model
         api_key = os.getenv("ANYSCALE_API_KEY")
         api_base = os.getenv("ANYSCALE_BASE_URL")
-        client = OpenAI(api_key=api_key, base_url=api_base)
+        client = get_client("anyscale", api_key=api_key, base_url=api_base)
         response = client.chat.completions.create(
             model=model,
             messages=messages,
@@ -120,3 +150,24 @@ class AnyscaleModelSync():
         message = response.choices[0].message
         parameters = json.loads(message.tool_calls[0].function.arguments)
         return FunctionResponse(parameters, tokens, cost)
+
+    def chat_candidates(self, messages, n=2, temperature=0.7, model=None):
+        """Ask for `n` alternative responses to the same messages in one request.
+
+        Returns:
+            list: A ChatResponse for each choice, with the tokens and cost of the request shared out between them.
+        """
+        if model is None:
+            model = self.model
+        api_key = os.getenv("ANYSCALE_API_KEY")
+        api_base = os.getenv("ANYSCALE_BASE_URL")
+        client = get_client("anyscale", api_key=api_key, base_url=api_base)
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            n=n,
+        )
+        tokens = response.usage.total_tokens
+        cost = (0.50 / 1000000) * tokens
+        return [ChatResponse(str(choice.message.content), tokens / len(response.choices), cost / len(response.choices), model) for choice in response.choices]
@@ -1,16 +1,110 @@
+import json
 from gepetto import anyscale, gpt, ollama, groq, claude
+from gepetto.cache import CachedBot
+from gepetto.hedging import HedgedBot
+from gepetto.limiter import ScheduledBot, get_scheduler
+from gepetto.streaming import StreamingBot
 
-def get_bot(model="gpt-4o", vendor="unknown"):
+# the LLM steps of the pipeline, each of which can be given its own model
+STAGES = ["thoughts", "module", "docs", "test", "filename", "repair"]
+
+def get_vendor_name(model="gpt-4o", vendor="unknown"):
+    # the vendor which really serves a model, which its rate limits and cached answers belong to
     if model.startswith('gpt'):
+        return "openai"
+    if model.startswith('claude'):
+        return "anthropic"
+    for vendor_name in ("ollama", "groq", "anyscale"):
+        if vendor.startswith(vendor_name):
+            return vendor_name
+    raise ValueError(f"Cannot find a bot for : {model} / {vendor}")
+
+def make_bot(model="gpt-4o", vendor="unknown"):
+    vendor_name = get_vendor_name(model, vendor)
+    if vendor_name == "openai":
         bot = gpt.GPTModelSync(model=model)
-    elif model.startswith('claude'):
+    elif vendor_name == "anthropic":
         bot = claude.ClaudeModelSync(model=model)
-    elif vendor.startswith('ollama'):
+    elif vendor_name == "ollama":
         bot = ollama.OllamaModelSync(model=model)
-    elif vendor.startswith('groq'):
+    elif vendor_name == "groq":
         bot = groq.GroqModelSync(model=model)
-    elif vendor.startswith('anyscale'):
-        bot = anyscale.MistralModelSync(model=model)
     else:
-        raise ValueError(f"Cannot find a bot for : {model} / {vendor}")
+        bot = anyscale.AnyscaleModelSync(model=model)
+    # every bot for a vendor shares its scheduler, so they share its rate limits
+    return ScheduledBot(bot, get_scheduler(vendor_name))
+
+def get_bot(model="gpt-4o", vendor="unknown", cache=False, refresh=False, stream=False, should_abort=None, hedge=None, hedge_after=None):
+    bot = make_bot(model, vendor)
+    if hedge is not None:
+        # hedge is the (model, vendor) to race slow chats against
+        bot = HedgedBot(bot, make_bot(*hedge), hedge_after=hedge_after)
+    if stream:
+        bot = StreamingBot(bot, should_abort=should_abort)
+    if cache:
+        # keyed on the vendor itself, not on whichever wrappers the bot happens to be in this time
+        bot = CachedBot(bot, vendor=get_vendor_name(model, vendor), refresh=refresh)
     return bot
+
+def get_stage_bots(model="gpt-4o", vendor="unknown", stage_models={}, cache=False, refresh=False, stream=False, abort_checks={}, hedge=None, hedge_after=None):
+    """Get a bot for every stage in STAGES.
+
+    Stages not in stage_models ({stage: (model, vendor)}) use the default model and vendor.  When streaming,
+    abort_checks ({stage: should_abort}) can stop a stage's responses early.  With a hedge (model, vendor), each
+    stage's slow chats are raced against that model, going by how long that stage's chats usually take.  Otherwise
+    stages using the same model, vendor and abort check share a bot.
+    """
+    bots = {}
+    by_model = {}
+    for stage in STAGES:
+        stage_model, stage_vendor = stage_models.get(stage, (model, vendor))
+        should_abort = abort_checks.get(stage) if stream else None
+        key = (stage_model, stage_vendor, should_abort, stage if hedge is not None else None)
+        if key not in by_model:
+            by_model[key] = get_bot(model=stage_model, vendor=stage_vendor, cache=cache, refresh=refresh, stream=stream, should_abort=should_abort, hedge=hedge, hedge_after=hedge_after)
+        bots[stage] = by_model[key]
+    return bots
+
+def parse_stage_model(value, default_vendor=""):
+    # "model" or "model@vendor"
+    model, _, vendor = value.partition("@")
+    return model, vendor or default_vendor
+
+def get_stage_models(specs=[], config_file="", default_vendor=""):
+    """Work out which stages use which models from `stage=model[@vendor]` strings and/or a JSON config file.
+
+    The config file maps stage names to either "model[@vendor]" or {"model": ..., "vendor": ...}.  The specs
+    win over the config file.
+    """
+    stage_models = {}
+    if config_file:
+        with open(config_file, "r") as f:
+            config = json.load(f)
+        for stage, value in config.items():
+            if isinstance(value, dict):
+                stage_models[stage] = (value["model"], value.get("vendor", default_vendor))
+            else:
+                stage_models[stage] = parse_stage_model(value, default_vendor)
+    for spec in specs:
+        stage, separator, value = spec.partition("=")
+        if not separator or not value:
+            raise ValueError(f"Stage models should look like stage=model[@vendor], not : {spec}")
+        stage_models[stage.strip()] = parse_stage_model(value.strip(), default_vendor)
+    unknown = set(stage_models) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages : {', '.join(sorted(unknown))} (should be one of {', '.join(STAGES)})")
+    return stage_models
+
+def get_rate_limits(specs=[]):
+    """Parse `vendor=requests_per_minute[/tokens_per_minute]` strings into {vendor: (requests, tokens)}."""
+    limits = {}
+    for spec in specs:
+        vendor, separator, value = spec.partition("=")
+        requests_per_minute, _, tokens_per_minute = value.partition("/")
+        try:
+            limits[vendor.strip()] = (int(requests_per_minute) if requests_per_minute else None, int(tokens_per_minute) if tokens_per_minute else None)
+        except ValueError:
+            separator = ""
+        if not separator:
+            raise ValueError(f"Rate limits should look like vendor=requests_per_minute[/tokens_per_minute], not : {spec}")
+    return limits
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from gepetto.response import ChatResponse
+
+class CachedBot():
+    """Wraps any bot from bot_factory.get_bot and keeps its chat responses on disk.
+
+    Responses are keyed on a hash of the vendor, model, messages, temperature and top_p, so asking the
+    same question twice only pays for it once.  vendor is the vendor's name (eg "openai"); if it isn't given
+    the wrapped bot's class name stands in for it.  Anything not to do with chat is passed straight through
+    to the wrapped bot.
+
+    Attributes:
+        hits (int): The number of chats answered from the cache.
+        misses (int): The number of chats sent on to the model.
+        saved_cost (float): The estimated cost in USD of the chats answered from the cache.
+    """
+    def __init__(self, bot, vendor="", cache_dir=".llm_cache", refresh=False, max_age=7 * 24 * 60 * 60, max_size=100 * 1024 * 1024):
+        self.bot = bot
+        self.vendor = vendor or type(bot).__name__
+        self.cache_dir = cache_dir
+        self.refresh = refresh
+        self.max_age = max_age
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.saved_cost = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __getattr__(self, name):
+        return getattr(self.bot, name)
+
+    def cache_key(self, messages, temperature=None, model=None, top_p=None):
+        key = json.dumps({
+            "vendor": self.vendor,
+            "model": model or self.bot.model,
+            "messages": messages,
+            "temperature": temperature,
+            "top_p": top_p,
+        }, sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def chat(self, messages, **kwargs):
+        path = os.path.join(self.cache_dir, f"{self.cache_key(messages, **kwargs)}.json")
+        if not self.refresh:
+            response = self.load(path)
+            if response is not None:
+                with self.lock:
+                    self.hits += 1
+                    self.saved_cost += response.cost
+                # nothing was spent getting it this time
+                return ChatResponse(response.message, response.tokens, 0, response.model)
+
+        response = self.bot.chat(messages, **kwargs)
+        with self.lock:
+            self.misses += 1
+        if getattr(response, "aborted", False):
+            # a stream cut off part way isn't worth keeping
+            return response
+        self.store(path, response)
+        self.evict()
+        return response
+
+    def load(self, path):
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return ChatResponse(data["message"], data["tokens"], data["cost"], data["model"], data.get("cached_tokens", 0))
+
+    def store(self, path, response):
+        # write then rename so a concurrent reader never sees half a file
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({
+                "message": response.message,
+                "tokens": response.tokens,
+                "cost": response.cost,
+                "model": response.model,
+                "cached_tokens": response.cached_tokens,
+            }, f)
+        os.replace(temp_path, path)
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if time.time() - stat.st_mtime > self.max_age:
+                self.remove(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            self.remove(path)
+            total_size -= size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self):
+        return f"{self.hits} hits, {self.misses} misses (saved ${round(self.saved_cost, 5)})"
+
+def cache_stats(bots):
+    """Add up the stats of the CachedBots behind some (possibly wrapped) bots, counting each cache once."""
+    caches = {}
+    for bot in bots:
+        # unwrap LimitedBot/RecordingBot etc until we get to the cache
+        while not isinstance(bot, CachedBot) and "bot" in vars(bot):
+            bot = bot.bot
+        if isinstance(bot, CachedBot):
+            caches[id(bot)] = bot
+    hits = sum(cache.hits for cache in caches.values())
+    misses = sum(cache.misses for cache in caches.values())
+    saved_cost = sum(cache.saved_cost for cache in caches.values())
+    return f"{hits} hits, {misses} misses (saved ${round(saved_cost, 5)})"
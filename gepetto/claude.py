@@ -1,7 +1,8 @@
+import asyncio
 import os
 import json
 from enum import Enum
-import anthropic
+from gepetto.clients import get_client, get_async_client
 from gepetto.response import ChatResponse, FunctionResponse
 
 class Model(Enum):
@@ -10,6 +11,27 @@ class Model(Enum):
     CLAUDE_35_SONNET = ('claude-3-5-sonnet-20240620', 3.00, 15.00)
     CLAUDE_3_OPUS = ('claude-3-opus-20240307', 15.00, 75.00)
 
+# prompt cache writes and reads are charged at these multiples of the input price
+CACHE_WRITE_PRICE = 1.25
+CACHE_READ_PRICE = 0.1
+
+def split_system_prompt(messages):
+    """Pull the system prompt out of an OpenAI-style message list, as Anthropic wants it passed separately.
+
+    The system prompts are long and the same on every call, so the block is marked for Anthropic's prompt cache.
+    Prompts shorter than the model's minimum cacheable length are just sent as normal.
+    """
+    claude_messages = []
+    system_prompt = ""
+    for message in messages:
+        if message["role"] == "system":
+            system_prompt = message["content"]
+        else:
+            claude_messages.append(message)
+    if not system_prompt:
+        return system_prompt, claude_messages
+    return [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}], claude_messages
+
 class ClaudeModel():
     name = "Minxie"
 
@@ -31,14 +53,35 @@ class ClaudeModel():
                 break
         if direction == "input":
             return round(token_price_input * token_count, 4)
+        if direction == "cache_write":
+            return round(token_price_input * CACHE_WRITE_PRICE * token_count, 4)
+        if direction == "cache_read":
+            return round(token_price_input * CACHE_READ_PRICE * token_count, 4)
         return round(token_price_output * token_count, 4)
 
-    async def chat(self, messages, temperature=0.7, model=None):
+    def get_usage_cost(self, usage, model_engine=None):
+        """Work out the tokens, cached tokens and cost of a request from its usage.
+
+        Anthropic counts the tokens written to and read from the prompt cache separately from the other input tokens.
+        """
+        cache_write_tokens = getattr(usage, "cache_creation_input_tokens", 0) or 0
+        cache_read_tokens = getattr(usage, "cache_read_input_tokens", 0) or 0
+        tokens = usage.input_tokens + cache_write_tokens + cache_read_tokens + usage.output_tokens
+        cost = (
+            self.get_token_price(usage.input_tokens, "input", model_engine)
+            + self.get_token_price(cache_write_tokens, "cache_write", model_engine)
+            + self.get_token_price(cache_read_tokens, "cache_read", model_engine)
+            + self.get_token_price(usage.output_tokens, "output", model_engine)
+        )
+        return tokens, cache_read_tokens, cost
+
+    async def chat(self, messages, temperature=0.7, model=None, timeout=120):
         """Chat with the model.
 
         Args:
             messages (list): The messages to send to the model.
             temperature (float): The temperature to use for the model.
+            timeout (float): Seconds to wait for the whole request before raising asyncio.TimeoutError.
 
         Returns:
             str: The response from the model.
@@ -48,28 +91,19 @@ class ClaudeModel():
         if model is None:
             model = self.model
         api_key = os.getenv("CLAUDE_API_KEY")
-        client = anthropic.Anthropic(
-            api_key=api_key,
-        )
-        claude_messages = []
-        system_prompt = ""
-        for message in messages:
-            if message["role"] == "system":
-                system_prompt = message["content"]
-            else:
-                claude_messages.append(message)
-        response = client.messages.create(
+        client = get_async_client("anthropic", api_key=api_key)
+        system_blocks, claude_messages = split_system_prompt(messages)
+        response = await asyncio.wait_for(client.messages.create(
             model=model,
             max_tokens=1000,
             temperature=0,
-            system=system_prompt,
+            system=system_blocks,
             messages=claude_messages
-        )
+        ), timeout)
         print(response.content)
-        tokens = response.usage.input_tokens + response.usage.output_tokens
-        cost = self.get_token_price(tokens, "output", model) + self.get_token_price(response.usage.input_tokens, "input", model)
+        tokens, cached_tokens, cost = self.get_usage_cost(response.usage, model)
         message = str(response.content[0].text)
-        return ChatResponse(message, tokens, cost, model)
+        return ChatResponse(message, tokens, cost, model, cached_tokens)
 
     async def function_call(self, messages = [], tools = [], temperature=0.7, model="mistralai/Mistral-7B-Instruct-v0.1"):
         raise NotImplementedError
@@ -95,8 +129,28 @@ class ClaudeModelSync():
                 break
         if direction == "input":
             return round(token_price_input * token_count, 4)
+        if direction == "cache_write":
+            return round(token_price_input * CACHE_WRITE_PRICE * token_count, 4)
+        if direction == "cache_read":
+            return round(token_price_input * CACHE_READ_PRICE * token_count, 4)
         return round(token_price_output * token_count, 4)
 
+    def get_usage_cost(self, usage, model_engine=None):
+        """Work out the tokens, cached tokens and cost of a request from its usage.
+
+        Anthropic counts the tokens written to and read from the prompt cache separately from the other input tokens.
+        """
+        cache_write_tokens = getattr(usage, "cache_creation_input_tokens", 0) or 0
+        cache_read_tokens = getattr(usage, "cache_read_input_tokens", 0) or 0
+        tokens = usage.input_tokens + cache_write_tokens + cache_read_tokens + usage.output_tokens
+        cost = (
+            self.get_token_price(usage.input_tokens, "input", model_engine)
+            + self.get_token_price(cache_write_tokens, "cache_write", model_engine)
+            + self.get_token_price(cache_read_tokens, "cache_read", model_engine)
+            + self.get_token_price(usage.output_tokens, "output", model_engine)
+        )
+        return tokens, cache_read_tokens, cost
+
     def chat(self, messages, temperature=0.7, model=None):
         """Chat with the model.
 
@@ -112,27 +166,57 @@ class ClaudeModelSync():
         if model is None:
             model = self.model
         api_key = os.getenv("CLAUDE_API_KEY")
-        client = anthropic.Anthropic(
-            api_key=api_key,
-        )
-        claude_messages = []
-        system_prompt = ""
-        for message in messages:
-            if message["role"] == "system":
-                system_prompt = message["content"]
-            else:
-                claude_messages.append(message)
+        client = get_client("anthropic", api_key=api_key)
+        system_blocks, claude_messages = split_system_prompt(messages)
         response = client.messages.create(
             model=model,
             max_tokens=4000,
             temperature=0.1,
-            system=system_prompt,
+            system=system_blocks,
             messages=claude_messages
         )
-        tokens = response.usage.input_tokens + response.usage.output_tokens
-        cost = self.get_token_price(tokens, "output", model) + self.get_token_price(response.usage.input_tokens, "input", model)
+        tokens, cached_tokens, cost = self.get_usage_cost(response.usage, model)
         message = str(response.content[0].text)
-        return ChatResponse(message, tokens, cost, model)
+        return ChatResponse(message, tokens, cost, model, cached_tokens)
+
+    def stream(self, messages, temperature=0.7, model=None):
+        """Chat with the model, yielding the text of the response as it arrives.
+
+        Use gepetto.streaming.chat_streaming to get a timed ChatResponse from this.
+
+        Returns:
+            dict: Once the stream is finished, the input_tokens, output_tokens, cached_tokens and cost of the request,
+                or None if the vendor didn't send them.
+        """
+        if model is None:
+            model = self.model
+        api_key = os.getenv("CLAUDE_API_KEY")
+        client = get_client("anthropic", api_key=api_key)
+        system_blocks, claude_messages = split_system_prompt(messages)
+        response = client.messages.create(
+            model=model,
+            max_tokens=4000,
+            temperature=0.1,
+            system=system_blocks,
+            messages=claude_messages,
+            stream=True,
+        )
+        # the input usage comes with the first event and the output usage with the last
+        usage = None
+        try:
+            for event in response:
+                if event.type == "message_start":
+                    usage = event.message.usage
+                elif event.type == "content_block_delta" and getattr(event.delta, "text", None):
+                    yield event.delta.text
+                elif event.type == "message_delta" and usage is not None:
+                    usage.output_tokens = event.usage.output_tokens
+        finally:
+            response.response.close()
+        if usage is None:
+            return None
+        tokens, cached_tokens, cost = self.get_usage_cost(usage, model)
+        return {"input_tokens": tokens - usage.output_tokens, "output_tokens": usage.output_tokens, "cached_tokens": cached_tokens, "cost": cost}
 
     def function_call(self, messages = [], tools = [], temperature=0.7, model="mistralai/Mistral-7B-Instruct-v0.1"):
         raise NotImplementedError
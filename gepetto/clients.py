@@ -0,0 +1,83 @@
+import asyncio
+import threading
+import weakref
+import httpx
+from gepetto.limiter import get_scheduler
+
+# connection pool settings used for every client created from here on
+pool_limits = {
+    "max_connections": 20,
+    "max_keepalive_connections": 10,
+    "keepalive_expiry": 60,
+}
+
+clients = {}
+clients_lock = threading.Lock()
+# async clients hold connections bound to the event loop they were used on, so they're kept per loop
+async_clients = weakref.WeakKeyDictionary()
+
+def set_pool_limits(max_connections=None, max_keepalive_connections=None, keepalive_expiry=None):
+    """Change the connection pool limits for clients created after this call."""
+    if max_connections is not None:
+        pool_limits["max_connections"] = max_connections
+    if max_keepalive_connections is not None:
+        pool_limits["max_keepalive_connections"] = max_keepalive_connections
+    if keepalive_expiry is not None:
+        pool_limits["keepalive_expiry"] = keepalive_expiry
+
+def rate_limit_hook(vendor, is_async=False):
+    # every response's rate limit headers go to the vendor's scheduler, so it knows how much budget is left
+    def hook(response):
+        get_scheduler(vendor).update_from_headers(response.headers)
+
+    async def async_hook(response):
+        hook(response)
+
+    return async_hook if is_async else hook
+
+def make_http_client(vendor, vendor_module, is_async=False):
+    # newer SDKs ship their own httpx client classes with the right defaults, older ones take plain httpx clients
+    if is_async:
+        client_class = getattr(vendor_module, "DefaultAsyncHttpxClient", httpx.AsyncClient)
+    else:
+        client_class = getattr(vendor_module, "DefaultHttpxClient", httpx.Client)
+    return client_class(limits=httpx.Limits(**pool_limits), event_hooks={"response": [rate_limit_hook(vendor, is_async)]})
+
+def make_client(vendor, api_key, base_url, is_async=False):
+    # sync retries are left to the vendor's scheduler (see limiter.py) rather than the SDK, so they're counted and
+    # spaced out.  The async models don't go through a scheduler, so they keep the SDK's own retries.
+    retries = {} if is_async else {"max_retries": 0}
+    if vendor in ("openai", "ollama", "anyscale"):
+        import openai
+        client_class = openai.AsyncOpenAI if is_async else openai.OpenAI
+        return client_class(api_key=api_key, base_url=base_url, **retries, http_client=make_http_client(vendor, openai, is_async))
+    if vendor == "anthropic":
+        import anthropic
+        client_class = anthropic.AsyncAnthropic if is_async else anthropic.Anthropic
+        return client_class(api_key=api_key, **retries, http_client=make_http_client(vendor, anthropic, is_async))
+    if vendor == "groq":
+        import groq
+        client_class = groq.AsyncGroq if is_async else groq.Groq
+        return client_class(api_key=api_key, **retries, http_client=make_http_client(vendor, groq, is_async))
+    raise ValueError(f"Cannot make a client for vendor : {vendor}")
+
+def get_client(vendor, api_key=None, base_url=None):
+    """Get the long-lived client for a vendor/base_url/api_key, creating it on first use.
+
+    The client (and its pool of keep-alive connections) is shared by every model instance in the process.
+    """
+    key = (vendor, base_url, api_key)
+    with clients_lock:
+        if key not in clients:
+            clients[key] = make_client(vendor, api_key, base_url)
+        return clients[key]
+
+def get_async_client(vendor, api_key=None, base_url=None):
+    """Get the async client for a vendor/base_url/api_key on the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    key = (vendor, base_url, api_key)
+    with clients_lock:
+        loop_clients = async_clients.setdefault(loop, {})
+        if key not in loop_clients:
+            loop_clients[key] = make_client(vendor, api_key, base_url, is_async=True)
+        return loop_clients[key]
@@ -1,7 +1,9 @@
+import asyncio
 import os
 import json
 from enum import Enum
-from openai import OpenAI
+from gepetto.clients import get_client, get_async_client
+from gepetto.streaming import read_openai_stream
 from gepetto.response import ChatResponse, FunctionResponse
 
 class Model(Enum):
@@ -16,6 +18,9 @@ class Model(Enum):
     GPT3_5_Turbo_16k = ('gpt-3.5-turbo-16k', 0.003, 0.004)
     GPT3_5_Turbo = ('gpt-3.5-turbo', 0.0015, 0.002)
 
+# cached prompt tokens are charged at this fraction of the input price
+CACHED_INPUT_PRICE = 0.5
+
 class GPTModel():
     name = "Gepetto"
 
@@ -37,14 +42,29 @@ class GPTModel():
                 break
         if direction == "input":
             return round(token_price_input * token_count, 4)
+        if direction == "cached":
+            return round(token_price_input * CACHED_INPUT_PRICE * token_count, 4)
         return round(token_price_output * token_count, 4)
 
-    async def chat(self, messages, temperature=1.8, model=None, top_p=0.6):
+    def get_usage_cost(self, usage, model_engine=None):
+        """Work out the tokens, cached tokens and cost of a request from its usage.
+
+        OpenAI caches long prompt prefixes by itself and counts the cached tokens within the prompt tokens.
+        """
+        cached_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", 0) or 0
+        input_tokens = usage.prompt_tokens - cached_tokens
+        output_tokens = usage.completion_tokens
+        tokens = usage.prompt_tokens + output_tokens
+        cost = self.get_token_price(input_tokens, "input", model_engine) + self.get_token_price(cached_tokens, "cached", model_engine) + self.get_token_price(output_tokens, "output", model_engine)
+        return tokens, cached_tokens, cost
+
+    async def chat(self, messages, temperature=1.8, model=None, top_p=0.6, timeout=120):
         """Chat with the model.
 
         Args:
             messages (list): The messages to send to the model.
             temperature (float): The temperature to use for the model.
+            timeout (float): Seconds to wait for the whole request before raising asyncio.TimeoutError.
 
         Returns:
             str: The response from the model.
@@ -55,41 +75,35 @@ class GPTModel():
             model = self.model
         api_key = os.getenv("OPENAI_API_KEY")
         api_base = "https://api.openai.com/v1/"
-        client = OpenAI(api_key=api_key, base_url=api_base)
-        response = client.chat.completions.create(
+        client = get_async_client("openai", api_key=api_key, base_url=api_base)
+        response = await asyncio.wait_for(client.chat.completions.create(
             model=model,
             messages=messages,
             temperature=temperature,
             top_p=top_p,
-        )
+        ), timeout)
         # print(str(response.choices[0].message))
-        input_tokens = response.usage.prompt_tokens
-        output_tokens = response.usage.completion_tokens
-        tokens = input_tokens + output_tokens
-        output_cost = self.get_token_price(output_tokens, "output", model)
-        input_cost = self.get_token_price(input_tokens, "input", model)
-        cost = input_cost + output_cost
+        tokens, cached_tokens, cost = self.get_usage_cost(response.usage, model)
         message = str(response.choices[0].message.content)
-        return ChatResponse(message, tokens, cost, model)
+        return ChatResponse(message, tokens, cost, model, cached_tokens)
 
-    async def function_call(self, messages = [], tools = [], temperature=0.7, model=None):
+    async def function_call(self, messages = [], tools = [], temperature=0.7, model=None, timeout=120):
         if model is None:
             model = self.model
         api_key = os.getenv("OPENAI_API_KEY")
         api_base = "https://api.openai.com/v1/"
-        client = OpenAI(api_key=api_key, base_url=api_base)
-        response = client.chat.completions.create(
+        client = get_async_client("openai", api_key=api_key, base_url=api_base)
+        response = await asyncio.wait_for(client.chat.completions.create(
             model=model,
             messages=messages,
             tools=tools,
             tool_choice={"type": "function", "function": {"name": tools[0]["function"]["name"]}},
-        )
+        ), timeout)
         # print(str(response.choices[0].message))
-        tokens = response.usage.total_tokens
-        cost = self.get_token_price(tokens, "output", model)
+        tokens, cached_tokens, cost = self.get_usage_cost(response.usage, model)
         message = response.choices[0].message
         parameters = json.loads(message.tool_calls[0].function.arguments)
-        return FunctionResponse(parameters, tokens, cost)
+        return FunctionResponse(parameters, tokens, cost, cached_tokens)
 
 class GPTModelSync():
     name = "Gepetto"
@@ -112,9 +126,23 @@ class GPTModelSync():
                 break
         if direction == "input":
             return round(token_price_input * token_count, 4)
+        if direction == "cached":
+            return round(token_price_input * CACHED_INPUT_PRICE * token_count, 4)
         return round(token_price_output * token_count, 4)
 
-    def chat(self, messages, temperature=0.1, model=Model.GPT_4_OMNI_0806.value[0], top_p=1.0):
+    def get_usage_cost(self, usage, model_engine=None):
+        """Work out the tokens, cached tokens and cost of a request from its usage.
+
+        OpenAI caches long prompt prefixes by itself and counts the cached tokens within the prompt tokens.
+        """
+        cached_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", 0) or 0
+        input_tokens = usage.prompt_tokens - cached_tokens
+        output_tokens = usage.completion_tokens
+        tokens = usage.prompt_tokens + output_tokens
+        cost = self.get_token_price(input_tokens, "input", model_engine) + self.get_token_price(cached_tokens, "cached", model_engine) + self.get_token_price(output_tokens, "output", model_engine)
+        return tokens, cached_tokens, cost
+
+    def chat(self, messages, temperature=0.1, model=None, top_p=1.0):
         """Chat with the model.
 
         Args:
@@ -130,7 +158,7 @@ class GPTModelSync():
             model = self.model
         api_key = os.getenv("OPENAI_API_KEY")
         api_base = "https://api.openai.com/v1/"
-        client = OpenAI(api_key=api_key, base_url=api_base)
+        client = get_client("openai", api_key=api_key, base_url=api_base)
         response = client.chat.completions.create(
             model=model,
             messages=messages,
@@ -138,21 +166,44 @@ class GPTModelSync():
             top_p=top_p,
         )
         # print(str(response.choices[0].message))
-        input_tokens = response.usage.prompt_tokens
-        output_tokens = response.usage.completion_tokens
-        tokens = input_tokens + output_tokens
-        output_cost = self.get_token_price(output_tokens, "output", model)
-        input_cost = self.get_token_price(input_tokens, "input", model)
-        cost = input_cost + output_cost
+        tokens, cached_tokens, cost = self.get_usage_cost(response.usage, model)
         message = str(response.choices[0].message.content)
-        return ChatResponse(message, tokens, cost, model)
+        return ChatResponse(message, tokens, cost, model, cached_tokens)
+
+    def stream(self, messages, temperature=0.1, model=None, top_p=1.0):
+        """Chat with the model, yielding the text of the response as it arrives.
+
+        Use gepetto.streaming.chat_streaming to get a timed ChatResponse from this.
+
+        Returns:
+            dict: Once the stream is finished, the input_tokens, output_tokens, cached_tokens and cost of the request,
+                or None if the vendor didn't send them.
+        """
+        if model is None:
+            model = self.model
+        api_key = os.getenv("OPENAI_API_KEY")
+        api_base = "https://api.openai.com/v1/"
+        client = get_client("openai", api_key=api_key, base_url=api_base)
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            top_p=top_p,
+            stream=True,
+            extra_body={"stream_options": {"include_usage": True}},
+        )
+        usage = yield from read_openai_stream(response)
+        if usage is None:
+            return None
+        tokens, cached_tokens, cost = self.get_usage_cost(usage, model)
+        return {"input_tokens": usage.prompt_tokens, "output_tokens": usage.completion_tokens, "cached_tokens": cached_tokens, "cost": cost}
 
     def function_call(self, messages = [], tools = [], temperature=0.7, model=None):
         if model is None:
             model = self.model
         api_key = os.getenv("OPENAI_API_KEY")
         api_base = "https://api.openai.com/v1/"
-        client = OpenAI(api_key=api_key, base_url=api_base)
+        client = get_client("openai", api_key=api_key, base_url=api_base)
         response = client.chat.completions.create(
             model=model,
             messages=messages,
@@ -160,8 +211,29 @@ class GPTModelSync():
             tool_choice={"type": "function", "function": {"name": tools[0]["function"]["name"]}},
         )
         # print(str(response.choices[0].message))
-        tokens = response.usage.total_tokens
-        cost = self.get_token_price(tokens, "output", model)
+        tokens, cached_tokens, cost = self.get_usage_cost(response.usage, model)
         message = response.choices[0].message
         parameters = json.loads(message.tool_calls[0].function.arguments)
-        return FunctionResponse(parameters, tokens, cost)
+        return FunctionResponse(parameters, tokens, cost, cached_tokens)
+
+    def chat_candidates(self, messages, n=2, temperature=0.7, model=None, top_p=1.0):
+        """Ask for `n` alternative responses to the same messages in one request.
+
+        Returns:
+            list: A ChatResponse for each choice, with the tokens and cost of the request shared out between them.
+        """
+        if model is None:
+            model = self.model
+        api_key = os.getenv("OPENAI_API_KEY")
+        api_base = "https://api.openai.com/v1/"
+        client = get_client("openai", api_key=api_key, base_url=api_base)
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            top_p=top_p,
+            n=n,
+        )
+        tokens, cached_tokens, cost = self.get_usage_cost(response.usage, model)
+        count = len(response.choices)
+        return [ChatResponse(str(choice.message.content), tokens / count, cost / count, model, cached_tokens / count) for choice in response.choices]
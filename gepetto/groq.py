@@ -1,6 +1,8 @@
+import asyncio
 import os
 import json
-from groq import Groq
+from gepetto.clients import get_client, get_async_client
+from gepetto.streaming import read_openai_stream
 from gepetto.response import ChatResponse, FunctionResponse
 class GroqModel():
     name = "RecipeThis"
@@ -14,12 +16,13 @@ class GroqModel():
     def get_token_price(self, token_count, direction="output", model_engine=None):
         return (0.50 / 1000000) * token_count
 
-    async def chat(self, messages, temperature=0.7, model=None):
+    async def chat(self, messages, temperature=0.7, model=None, timeout=120):
         """Chat with the model.
 
         Args:
             messages (list): The messages to send to the model.
             temperature (float): The temperature to use for the model.
+            timeout (float): Seconds to wait for the whole request before raising asyncio.TimeoutError.
 
         Returns:
             str: The response from the model.
@@ -29,12 +32,12 @@ class GroqModel():
         if model is None:
             model = self.model
         api_key = os.getenv("GROQ_API_KEY")
-        client = Groq(api_key=api_key)
-        response = client.chat.completions.create(
+        client = get_async_client("groq", api_key=api_key)
+        response = await asyncio.wait_for(client.chat.completions.create(
             model=model,
             messages=messages,
             temperature=0.7,
-        )
+        ), timeout)
         # print(str(response.choices[0].message))
         tokens = response.usage.total_tokens
         cost = (0.50 / 1000000) * tokens
@@ -70,7 +73,7 @@ class GroqModelSync():
         if model is None:
             model = self.model
         api_key = os.getenv("GROQ_API_KEY")
-        client = Groq(api_key=api_key)
+        client = get_client("groq", api_key=api_key)
         response = client.chat.completions.create(
             model=model,
             messages=messages,
@@ -83,5 +86,32 @@ class GroqModelSync():
         message = str(response.choices[0].message.content)
         return ChatResponse(message, tokens, cost, model)
 
+    def stream(self, messages, temperature=0.7, model=None):
+        """Chat with the model, yielding the text of the response as it arrives.
+
+        Use gepetto.streaming.chat_streaming to get a timed ChatResponse from this.
+
+        Returns:
+            dict: Once the stream is finished, the input_tokens, output_tokens, cached_tokens and cost of the request,
+                or None if the vendor didn't send them.
+        """
+        if model is None:
+            model = self.model
+        api_key = os.getenv("GROQ_API_KEY")
+        client = get_client("groq", api_key=api_key)
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0.7,
+            timeout=30,
+            stream=True,
+            extra_body={"stream_options": {"include_usage": True}},
+        )
+        usage = yield from read_openai_stream(response)
+        if usage is None:
+            return None
+        cost = (0.50 / 1000000) * usage.total_tokens
+        return {"input_tokens": usage.prompt_tokens, "output_tokens": usage.completion_tokens, "cached_tokens": 0, "cost": cost}
+
     def function_call(self, messages = [], tools = [], temperature=0.7, model=None):
         raise NotImplementedError
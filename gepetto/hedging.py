@@ -0,0 +1,120 @@
+import collections
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from gepetto.streaming import chat_streaming
+
+# shared by every HedgedBot.  Losing requests can take a moment to wind down, so there's plenty of room.
+hedge_executor = ThreadPoolExecutor(max_workers=32)
+
+class HedgedBot():
+    """Wraps a bot so that a chat which is taking too long is raced against the same chat to a backup bot.
+
+    Once a chat has been going for longer than `hedge_after` seconds (or, if that's not given, longer than the
+    `percent` percentile of the chats so far) the same messages are sent to the backup, and whichever answers
+    first wins.  The other is cancelled: bots with a `stream` method drop the connection as soon as they hear
+    back, others are left to finish and their answer thrown away.  Either way the loser's cost is counted in
+    extra_cost.  Only chat is hedged, anything else goes straight to the main bot.
+
+    Attributes:
+        calls (int): The number of chats.
+        hedged (int): How many of them were sent to the backup too.
+        backup_wins (int): How many of those the backup answered first.
+        extra_cost (float): The cost in USD of the answers thrown away.
+    """
+    def __init__(self, bot, backup, hedge_after=None, percent=90, min_samples=10, default_hedge_after=30, history=200):
+        self.bot = bot
+        self.backup = backup
+        self.hedge_after = hedge_after
+        self.percent = percent
+        self.min_samples = min_samples
+        self.default_hedge_after = default_hedge_after
+        self.latencies = collections.deque(maxlen=history)
+        self.calls = 0
+        self.hedged = 0
+        self.backup_wins = 0
+        self.extra_cost = 0
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name == "stream":
+            # a hedged chat isn't one stream, so don't let StreamingBot treat this as one
+            raise AttributeError(name)
+        return getattr(self.bot, name)
+
+    def threshold(self):
+        if self.hedge_after is not None:
+            return self.hedge_after
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < self.min_samples:
+            return self.default_hedge_after
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.percent / 100))]
+
+    def chat(self, messages, **kwargs):
+        start_time = time.monotonic()
+        primary_cancelled = threading.Event()
+        primary = hedge_executor.submit(self.ask, self.bot, messages, primary_cancelled, kwargs)
+        done, _ = wait([primary], timeout=self.threshold())
+        if done:
+            response = primary.result()
+            with self.lock:
+                self.calls += 1
+                self.latencies.append(time.monotonic() - start_time)
+            return response
+
+        # the backup has its own model, so it only gets the sampling settings
+        backup_kwargs = {key: value for key, value in kwargs.items() if key != "model"}
+        backup_cancelled = threading.Event()
+        backup = hedge_executor.submit(self.ask, self.backup, messages, backup_cancelled, backup_kwargs)
+        with self.lock:
+            self.calls += 1
+            self.hedged += 1
+        racers = {primary: primary_cancelled, backup: backup_cancelled}
+        pending = set(racers)
+        winner = None
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and winner is None:
+                    winner = future
+        if winner is None:
+            # both failed, so pass on the main bot's error
+            return primary.result()
+
+        with self.lock:
+            self.latencies.append(time.monotonic() - start_time)
+            if winner is backup:
+                self.backup_wins += 1
+        for future, cancelled in racers.items():
+            if future is not winner:
+                cancelled.set()
+                future.add_done_callback(self.count_extra_cost)
+        return winner.result()
+
+    def ask(self, bot, messages, cancelled, kwargs):
+        if hasattr(bot, "stream"):
+            return chat_streaming(bot, messages, should_abort=lambda text: cancelled.is_set(), **kwargs)
+        return bot.chat(messages, **kwargs)
+
+    def count_extra_cost(self, future):
+        if future.exception() is None:
+            with self.lock:
+                self.extra_cost += future.result().cost
+
+def hedge_stats(bots):
+    """Add up the stats of the HedgedBots behind some (possibly wrapped) bots, counting each once."""
+    hedgers = {}
+    for bot in bots:
+        # unwrap CachedBot/RecordingBot etc until we get to the hedger
+        while not isinstance(bot, HedgedBot) and "bot" in vars(bot):
+            bot = bot.bot
+        if isinstance(bot, HedgedBot):
+            hedgers[id(bot)] = bot
+    if not hedgers:
+        return None
+    calls = sum(hedger.calls for hedger in hedgers.values())
+    hedged = sum(hedger.hedged for hedger in hedgers.values())
+    backup_wins = sum(hedger.backup_wins for hedger in hedgers.values())
+    extra_cost = sum(hedger.extra_cost for hedger in hedgers.values())
+    return f"{hedged} of {calls} chats hedged, backup won {backup_wins}, extra cost ${round(extra_cost, 5)}"
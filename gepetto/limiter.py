@@ -0,0 +1,312 @@
+import datetime
+import itertools
+import random
+import re
+import threading
+import time
+
+# requests and tokens per minute for each vendor, used for schedulers created from here on.  None means no
+# limit until the vendor's rate limit headers say otherwise.
+rate_limits = {
+    "openai": {"requests_per_minute": 500, "tokens_per_minute": 30000},
+    "anthropic": {"requests_per_minute": 50, "tokens_per_minute": 40000},
+    "groq": {"requests_per_minute": 30, "tokens_per_minute": 6000},
+    "anyscale": {"requests_per_minute": 30, "tokens_per_minute": None},
+    "ollama": {"requests_per_minute": None, "tokens_per_minute": None},
+}
+
+# HTTP statuses worth trying again after a pause (529 is Anthropic's "overloaded")
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504, 529}
+RETRYABLE_ERRORS = {"APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError", "OverloadedError"}
+
+# rough characters per token, for guessing what a request will use before it's sent
+CHARS_PER_TOKEN = 4
+
+schedulers = {}
+schedulers_lock = threading.Lock()
+
+class LimitedBot():
+    """Wraps a bot so that no more than `max_concurrent` chats are in flight through it at once.
+
+    Handy when lots of threads share a bot, eg in batch mode.  Pass the same `semaphore` to several LimitedBots
+    to share one limit between them.  Anything other than chat/function_call is passed straight through to the
+    wrapped bot.
+    """
+    def __init__(self, bot, max_concurrent=4, semaphore=None):
+        self.bot = bot
+        self.semaphore = semaphore or threading.BoundedSemaphore(max_concurrent)
+
+    def __getattr__(self, name):
+        return getattr(self.bot, name)
+
+    def chat(self, messages, **kwargs):
+        with self.semaphore:
+            return self.bot.chat(messages, **kwargs)
+
+    def function_call(self, messages=[], tools=[], **kwargs):
+        with self.semaphore:
+            return self.bot.function_call(messages, tools, **kwargs)
+
+class TokenBucket():
+    """A bucket holding up to `per_minute` of something, refilling at `per_minute` a minute."""
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount):
+        """Take `amount` out of the bucket, waiting until there's enough.  Returns the seconds spent waiting."""
+        # a request bigger than the whole bucket would wait forever, so it just waits for a full one
+        amount = min(amount, self.capacity)
+        waited = 0
+        while True:
+            with self.lock:
+                self.refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return waited
+                delay = (amount - self.level) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def adjust(self, amount):
+        # eg once a request's real token count is known.  The level can go negative, which holds later requests back.
+        with self.lock:
+            self.refill()
+            self.level -= amount
+
+    def sync(self, remaining):
+        # the vendor's own count wins if it has less left than we thought
+        with self.lock:
+            self.refill()
+            self.level = min(self.level, remaining)
+
+def parse_reset(value):
+    """Turn a rate limit reset header into seconds from now.
+
+    OpenAI and Groq send durations like "6m0s" or "20ms", Anthropic sends an RFC 3339 time.
+    """
+    if not value:
+        return None
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if parts and "".join(number + unit for number, unit in parts) == value:
+        scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return sum(float(number) * scale[unit] for number, unit in parts)
+    try:
+        reset_time = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max(0, (reset_time - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+def estimate_tokens(messages):
+    return sum(len(str(message.get("content", ""))) for message in messages) // CHARS_PER_TOKEN
+
+def response_tokens(result):
+    responses = result if isinstance(result, list) else [result]
+    return sum(getattr(response, "tokens", 0) for response in responses)
+
+class VendorScheduler():
+    """Holds the requests to one vendor to its requests-per-minute and tokens-per-minute budgets, and retries
+    the ones that fail for reasons worth retrying, with jittered exponential backoff.
+
+    Attributes:
+        waiting (int): How many requests are queued waiting for their turn right now.
+        max_waiting (int): The longest the queue has been.
+        throttle_seconds (float): The total time requests have spent queued.
+        backoff_seconds (float): The total time spent waiting to retry failed requests.
+        requests (int): How many requests have been sent.
+        retries (int): How many of those were retries.
+        failures (int): How many requests failed for good.
+    """
+    def __init__(self, vendor, requests_per_minute=None, tokens_per_minute=None, max_retries=4, base_delay=1, max_delay=60):
+        self.vendor = vendor
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.paused_until = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.throttle_seconds = 0
+        self.backoff_seconds = 0
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def wait_for_turn(self, tokens):
+        with self.lock:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+        start_time = time.monotonic()
+        try:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            if self.request_bucket is not None:
+                self.request_bucket.take(1)
+            if self.token_bucket is not None and tokens:
+                self.token_bucket.take(tokens)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+                self.throttle_seconds += time.monotonic() - start_time
+                self.requests += 1
+
+    def used_tokens(self, estimated, actual):
+        if self.token_bucket is not None and actual:
+            self.token_bucket.adjust(actual - estimated)
+
+    def backoff(self, error, attempt):
+        """Wait before retrying a failed request.  Returns False (without waiting) if it shouldn't be retried."""
+        if attempt >= self.max_retries or not is_retryable(error):
+            with self.lock:
+                self.failures += 1
+            return False
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            # the vendor said how long to wait, so everyone else waits too
+            delay = min(retry_after, self.max_delay)
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        else:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        with self.lock:
+            self.retries += 1
+            self.backoff_seconds += delay
+        time.sleep(delay)
+        return True
+
+    def call(self, method, tokens, *args, **kwargs):
+        """Call `method` once there's room in the budgets, retrying it if it fails with a retryable error."""
+        for attempt in itertools.count():
+            self.wait_for_turn(tokens)
+            try:
+                result = method(*args, **kwargs)
+            except Exception as e:
+                if self.backoff(e, attempt):
+                    continue
+                raise
+            self.used_tokens(tokens, response_tokens(result))
+            return result
+
+    def update_from_headers(self, headers):
+        """Bring the budgets into line with the rate limit headers on a response from the vendor."""
+        for kind, per_minute in (("requests", "request_bucket"), ("tokens", "token_bucket")):
+            limit = headers.get(f"x-ratelimit-limit-{kind}") or headers.get(f"anthropic-ratelimit-{kind}-limit")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}") or headers.get(f"anthropic-ratelimit-{kind}-remaining")
+            reset = headers.get(f"x-ratelimit-reset-{kind}") or headers.get(f"anthropic-ratelimit-{kind}-reset")
+            try:
+                limit = float(limit) if limit is not None else None
+                remaining = float(remaining) if remaining is not None else None
+            except ValueError:
+                continue
+            bucket = getattr(self, per_minute)
+            if bucket is None and limit:
+                # no budget was set, so go by what the vendor says (taking it to be per minute, as it usually is)
+                bucket = TokenBucket(limit)
+                setattr(self, per_minute, bucket)
+            if bucket is not None and remaining is not None:
+                bucket.sync(remaining)
+            reset_seconds = parse_reset(reset)
+            if remaining is not None and remaining < 1 and reset_seconds:
+                # nothing left until the vendor's window resets
+                self.paused_until = max(self.paused_until, time.monotonic() + min(reset_seconds, self.max_delay))
+
+    def stats(self):
+        return f"{self.requests} requests, {self.retries} retries, {self.failures} failures, {round(self.throttle_seconds, 2)} seconds throttled, {round(self.backoff_seconds, 2)} seconds backing off, longest queue {self.max_waiting}"
+
+def is_retryable(error):
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    if getattr(error, "status_code", None) in RETRYABLE_STATUSES:
+        return True
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+def get_retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def set_rate_limit(vendor, requests_per_minute=None, tokens_per_minute=None):
+    """Change a vendor's budgets.  Schedulers already created for the vendor are updated too."""
+    limits = rate_limits.setdefault(vendor, {"requests_per_minute": None, "tokens_per_minute": None})
+    if requests_per_minute is not None:
+        limits["requests_per_minute"] = requests_per_minute
+    if tokens_per_minute is not None:
+        limits["tokens_per_minute"] = tokens_per_minute
+    with schedulers_lock:
+        scheduler = schedulers.get(vendor)
+        if scheduler is not None:
+            scheduler.request_bucket = TokenBucket(limits["requests_per_minute"]) if limits["requests_per_minute"] else None
+            scheduler.token_bucket = TokenBucket(limits["tokens_per_minute"]) if limits["tokens_per_minute"] else None
+
+def get_scheduler(vendor):
+    """Get the scheduler shared by every bot talking to a vendor, creating it on first use."""
+    with schedulers_lock:
+        if vendor not in schedulers:
+            limits = rate_limits.get(vendor, {})
+            schedulers[vendor] = VendorScheduler(vendor, limits.get("requests_per_minute"), limits.get("tokens_per_minute"))
+        return schedulers[vendor]
+
+def scheduler_stats():
+    with schedulers_lock:
+        return {vendor: scheduler.stats() for vendor, scheduler in schedulers.items() if scheduler.requests}
+
+class ScheduledBot():
+    """Wraps a bot so that its requests go through a VendorScheduler, waiting their turn and retrying on failure.
+
+    Streams are retried if they fail before the first of the response arrives, but not after.  Anything else is
+    passed straight through to the wrapped bot.
+    """
+    def __init__(self, bot, scheduler):
+        self.bot = bot
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        attribute = getattr(self.bot, name)
+        if name == "chat_candidates":
+            # only offered if the wrapped bot has it, so callers can still check with hasattr()
+            return lambda messages, **kwargs: self.scheduler.call(attribute, estimate_tokens(messages), messages, **kwargs)
+        if name == "stream":
+            return lambda messages, **kwargs: self.scheduled_stream(attribute, messages, **kwargs)
+        return attribute
+
+    def chat(self, messages, **kwargs):
+        return self.scheduler.call(self.bot.chat, estimate_tokens(messages), messages, **kwargs)
+
+    def function_call(self, messages=[], tools=[], **kwargs):
+        return self.scheduler.call(self.bot.function_call, estimate_tokens(messages), messages, tools, **kwargs)
+
+    def scheduled_stream(self, method, messages, **kwargs):
+        tokens = estimate_tokens(messages)
+        for attempt in itertools.count():
+            self.scheduler.wait_for_turn(tokens)
+            stream = method(messages, **kwargs)
+            try:
+                first_chunk = next(stream)
+            except StopIteration as stop:
+                return stop.value
+            except Exception as e:
+                if self.scheduler.backoff(e, attempt):
+                    continue
+                raise
+            break
+        try:
+            yield first_chunk
+            usage = yield from stream
+        finally:
+            stream.close()
+        if usage is not None:
+            self.scheduler.used_tokens(tokens, usage["input_tokens"] + usage["output_tokens"])
+        return usage
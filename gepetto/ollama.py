@@ -1,6 +1,8 @@
+import asyncio
 import os
 import json
-from openai import OpenAI
+from gepetto.clients import get_client, get_async_client
+from gepetto.streaming import read_openai_stream
 from gepetto.response import ChatResponse, FunctionResponse
 
 class OllamaModel():
@@ -15,12 +17,13 @@ class OllamaModel():
     def get_token_price(self, token_count, direction="output", model_engine=None):
         return 0
 
-    async def chat(self, messages, temperature=1.1, model=None):
+    async def chat(self, messages, temperature=1.1, model=None, timeout=120):
         """Chat with the model.
 
         Args:
             messages (list): The messages to send to the model.
             temperature (float): The temperature to use for the model.
+            timeout (float): Seconds to wait for the whole request before raising asyncio.TimeoutError.
 
         Returns:
             str: The response from the model.
@@ -29,15 +32,12 @@ class OllamaModel():
         """
         if model is None:
             model = self.model
-        client = OpenAI(
-            base_url = 'http://host.docker.internal:11434/v1',
-            api_key='ollama', # required, but unused
-        )
-        response = client.chat.completions.create(
+        client = get_async_client("ollama", api_key='ollama', base_url='http://host.docker.internal:11434/v1') # api key required, but unused
+        response = await asyncio.wait_for(client.chat.completions.create(
             model=model,
             messages=messages,
             temperature=temperature,
-        )
+        ), timeout)
         input_tokens = response.usage.prompt_tokens
         output_tokens = response.usage.completion_tokens
         tokens = input_tokens + output_tokens
@@ -55,7 +55,7 @@ class OllamaModelSync():
         if model is None:
             self.model = "dolphin-mistral"
         else:
-            self.model
+            self.model = model
 
     def get_token_price(self, token_count, direction="output", model_engine=None):
         return 0
@@ -74,10 +74,7 @@ class OllamaModelSync():
         """
         if model is None:
             model = self.model
-        client = OpenAI(
-            base_url = 'http://localhost:11434/v1',
-            api_key='ollama', # required, but unused
-        )
+        client = get_client("ollama", api_key='ollama', base_url='http://localhost:11434/v1') # api key required, but unused
         response = client.chat.completions.create(
             model=model,
             messages=messages,
@@ -90,5 +87,29 @@ class OllamaModelSync():
         message = str(response.choices[0].message.content)
         return ChatResponse(message, tokens, cost, model)
 
+    def stream(self, messages, temperature=1.1, model=None):
+        """Chat with the model, yielding the text of the response as it arrives.
+
+        Use gepetto.streaming.chat_streaming to get a timed ChatResponse from this.
+
+        Returns:
+            dict: Once the stream is finished, the input_tokens, output_tokens, cached_tokens and cost of the request,
+                or None if the vendor didn't send them.
+        """
+        if model is None:
+            model = self.model
+        client = get_client("ollama", api_key='ollama', base_url='http://localhost:11434/v1') # api key required, but unused
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            extra_body={"stream_options": {"include_usage": True}},
+        )
+        usage = yield from read_openai_stream(response)
+        if usage is None:
+            return None
+        return {"input_tokens": usage.prompt_tokens, "output_tokens": usage.completion_tokens, "cached_tokens": 0, "cost": 0}
+
     def function_call(self, messages = [], tools = [], temperature=0.7, model=None):
         raise NotImplementedError
@@ -0,0 +1,56 @@
+import threading
+import time
+from gepetto.streaming import StreamAborted
+
+class RecordingBot():
+    """Wraps a bot and adds the calls, cost, cached tokens and time of every request it makes to a tally dict.
+
+    The tally (with "calls", "cost", "cached_tokens", "seconds", "streamed", "first_token_seconds", "aborted" and
+    "aborted_cost" keys) belongs to the caller, so one bot can be wrapped several times to keep separate tallies, eg
+    one per pipeline stage.  The last four only count streamed responses.  A response cut off with StreamAborted is
+    tallied (its cost in "aborted_cost" as well, as the caller never gets to see it) before the error is passed on.
+    """
+    def __init__(self, bot, tally):
+        self.bot = bot
+        self.tally = tally
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.bot, name)
+        if name == "chat_candidates":
+            # only offered if the wrapped bot has it, so callers can still check with hasattr()
+            return self.recorded(attribute)
+        return attribute
+
+    def recorded(self, method):
+        def call(*args, **kwargs):
+            start_time = time.monotonic()
+            try:
+                result = method(*args, **kwargs)
+            except StreamAborted as e:
+                self.add(e.response, start_time)
+                with self.lock:
+                    self.tally["aborted_cost"] += e.response.cost
+                raise
+            self.add(result, start_time)
+            return result
+        return call
+
+    def add(self, result, start_time):
+        responses = result if isinstance(result, list) else [result]
+        with self.lock:
+            self.tally["calls"] += 1
+            self.tally["cost"] += sum(response.cost for response in responses)
+            self.tally["cached_tokens"] += sum(getattr(response, "cached_tokens", 0) for response in responses)
+            self.tally["seconds"] += time.monotonic() - start_time
+            for response in responses:
+                if hasattr(response, "first_token_seconds"):
+                    self.tally["streamed"] += 1
+                    self.tally["first_token_seconds"] += response.first_token_seconds
+                    self.tally["aborted"] += response.aborted
+
+    def chat(self, messages, **kwargs):
+        return self.recorded(self.bot.chat)(messages, **kwargs)
+
+    def function_call(self, messages=[], tools=[], **kwargs):
+        return self.recorded(self.bot.function_call)(messages, tools, **kwargs)
@@ -8,17 +8,36 @@ class ChatResponse:
         tokens (int): The number of tokens used.
         cost (float): The estimated cost of the request in USD.
         model (str): The model used to generate the response.
+        cached_tokens (int): How many of the input tokens were read from the provider's prompt cache.
     """
-    def __init__(self, message, tokens, cost, model="Unknown"):
+    def __init__(self, message, tokens, cost, model="Unknown", cached_tokens=0):
         self.message = message
         self.tokens = tokens
         self.cost = cost
         self.model = model
-        self.usage = f"_[Tokens used: {self.tokens} | Estimated cost US${round(self.cost, 5)}] | Model: {model}_"
+        self.cached_tokens = cached_tokens
+        cached = f" | Cached: {cached_tokens}" if cached_tokens else ""
+        self.usage = f"_[Tokens used: {self.tokens}{cached} | Estimated cost US${round(self.cost, 5)}] | Model: {model}_"
 
     def __str__(self):
         return f"{self.message}\n{self.usage}"
 
+class StreamedResponse(ChatResponse):
+    """A response which was streamed from the API.
+
+    Attributes:
+        first_token_seconds (float): How long it took for the first of the response to arrive.
+        tokens_per_second (float): How quickly the rest of the response arrived.
+        aborted (bool): Whether the stream was stopped early, leaving message incomplete.
+    """
+    def __init__(self, message, tokens, cost, model="Unknown", cached_tokens=0, first_token_seconds=0, tokens_per_second=0, aborted=False):
+        super().__init__(message, tokens, cost, model, cached_tokens)
+        self.first_token_seconds = first_token_seconds
+        self.tokens_per_second = tokens_per_second
+        self.aborted = aborted
+        if aborted:
+            self.usage += " _(aborted)_"
+
 class FunctionResponse:
     """A function call response from the API.
 
@@ -26,12 +45,15 @@ class FunctionResponse:
         parameters (dict): The parameters returned from the function call
         tokens (int): The number of tokens used.
         cost (float): The estimated cost of the request in USD.
+        cached_tokens (int): How many of the input tokens were read from the provider's prompt cache.
     """
-    def __init__(self, parameters, tokens, cost):
+    def __init__(self, parameters, tokens, cost, cached_tokens=0):
         self.parameters = parameters
         self.tokens = tokens
         self.cost = cost
-        self.usage = f"_[tokens used: {self.tokens} | Estimated cost US${round(self.cost, 5)}]_"
+        self.cached_tokens = cached_tokens
+        cached = f" | cached: {cached_tokens}" if cached_tokens else ""
+        self.usage = f"_[tokens used: {self.tokens}{cached} | Estimated cost US${round(self.cost, 5)}]_"
 
     def __str__(self):
         return f"{self.parameters}\n{self.usage}"
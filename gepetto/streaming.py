@@ -0,0 +1,114 @@
+import time
+from gepetto.response import StreamedResponse
+
+# rough characters per token, for estimating usage when a stream is cut off before the vendor reports it
+CHARS_PER_TOKEN = 4
+
+class StreamAborted(RuntimeError):
+    """Raised by StreamingBot when a response is cut off, so a half-written answer is never used as a whole one.
+
+    Attributes:
+        response (StreamedResponse): What arrived before the cut off, and what it cost.
+    """
+    def __init__(self, response):
+        super().__init__(f"The response from {response.model} was cut off after {len(response.message)} characters")
+        self.response = response
+
+def read_openai_stream(stream):
+    """Yield the text of an OpenAI-style chat completion stream as it arrives, returning the usage (if sent) at the end.
+
+    The HTTP response is closed however the stream ends, so a caller who stops early stops paying for it.
+    """
+    usage = None
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        stream.response.close()
+    return usage
+
+def estimate_usage(bot, messages, text, model=None):
+    input_tokens = sum(len(str(message["content"])) for message in messages) // CHARS_PER_TOKEN
+    output_tokens = len(text) // CHARS_PER_TOKEN
+    cost = bot.get_token_price(input_tokens, "input", model) + bot.get_token_price(output_tokens, "output", model)
+    return {"input_tokens": input_tokens, "output_tokens": output_tokens, "cached_tokens": 0, "cost": cost}
+
+def chat_streaming(bot, messages, should_abort=None, on_text=None, **kwargs):
+    """Chat with a bot that has a `stream` method, timing the response as it arrives.
+
+    Args:
+        bot: The bot to chat with.
+        messages (list): The messages to send to the model.
+        should_abort (callable): Called with the text so far after every chunk.  If it returns True the stream is
+            dropped and what arrived so far is returned.
+        on_text (callable): Called with the text so far after every chunk, eg to show progress.
+
+    Returns:
+        StreamedResponse: The response, with the time to first token, tokens per second and whether it was aborted.
+    """
+    start_time = time.monotonic()
+    first_token_time = None
+    text = ""
+    usage = None
+    aborted = False
+    stream = bot.stream(messages, **kwargs)
+    try:
+        while True:
+            try:
+                chunk = next(stream)
+            except StopIteration as stop:
+                usage = stop.value
+                break
+            if first_token_time is None:
+                first_token_time = time.monotonic()
+            text += chunk
+            if on_text is not None:
+                on_text(text)
+            if should_abort is not None and should_abort(text):
+                aborted = True
+                break
+    finally:
+        stream.close()
+    end_time = time.monotonic()
+
+    if usage is None:
+        # aborted, or the vendor didn't send usage with the stream
+        usage = estimate_usage(bot, messages, text, kwargs.get("model"))
+    first_token_seconds = (first_token_time if first_token_time is not None else end_time) - start_time
+    generating_seconds = end_time - first_token_time if first_token_time is not None else 0
+    tokens_per_second = usage["output_tokens"] / generating_seconds if generating_seconds > 0 else 0
+    return StreamedResponse(
+        text,
+        usage["input_tokens"] + usage["output_tokens"],
+        usage["cost"],
+        kwargs.get("model") or bot.model,
+        usage["cached_tokens"],
+        first_token_seconds=first_token_seconds,
+        tokens_per_second=tokens_per_second,
+        aborted=aborted,
+    )
+
+class StreamingBot():
+    """Wraps a bot so that its chats are streamed, with timings and an optional early abort.
+
+    Bots without a `stream` method just chat as normal.  Wrap the bot before any CachedBot, so that cached
+    answers don't go anywhere near the stream.  A chat which should_abort cuts off raises StreamAborted.
+    Anything other than chat is passed straight through.
+    """
+    def __init__(self, bot, should_abort=None):
+        self.bot = bot
+        self.should_abort = should_abort
+
+    def __getattr__(self, name):
+        return getattr(self.bot, name)
+
+    def chat(self, messages, **kwargs):
+        if not hasattr(self.bot, "stream"):
+            return self.bot.chat(messages, **kwargs)
+        response = chat_streaming(self.bot, messages, self.should_abort, **kwargs)
+        if response.aborted:
+            raise StreamAborted(response)
+        return response
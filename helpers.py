@@ -1,5 +1,7 @@
 import re
 import os
+from contextlib import nullcontext
+from yaspin import yaspin
 
 def remove_markdown(text):
     text = re.sub(r"```.*\n", "", text)
@@ -45,12 +47,137 @@ def get_requirements(requirements_file):
         requirements = input("Enter your requirements:\n")
     return requirements
 
-def remove_previous_log():
-    if os.path.exists("log.md"):
-        os.remove("log.md")
+def remove_previous_log(log_file="log.md"):
+    if os.path.exists(log_file):
+        os.remove(log_file)
 
-def write_to_log(title: str, message: str):
-    with open("log.md", "a") as f:
+def write_to_log(title: str, message: str, log_file="log.md"):
+    with open(log_file, "a") as f:
         f.write(f"\n# {title}\n\n")
         f.write(message)
         f.write("\n\n")
+
+def strip_puppet_comments(text):
+    # reduce puppet code to just its code, so two versions which only differ in comments/whitespace compare equal.
+    # String, regex and heredoc literals are kept exactly as they are, as whitespace (or a #) in them changes what
+    # they do.  A heredoc's body starts on the line after its @(TAG), so the rest of that line is still code.
+    pieces = []
+    code = []
+    heredoc_tags = []
+    after_literal = False
+    i = 0
+    while i < len(text):
+        char = text[i]
+        heredoc = HEREDOC_START.match(text, i) if char == "@" else None
+        if heredoc or (char == "\n" and heredoc_tags):
+            pieces.append(" ".join("".join(code).split()))
+            if heredoc:
+                pieces.append(heredoc.group(0))
+                heredoc_tags.append(heredoc.group(1))
+                i = heredoc.end()
+            else:
+                end = heredoc_end(text, i + 1, heredoc_tags)
+                pieces.append(text[i + 1:end])
+                heredoc_tags = []
+                i = end
+            code = []
+            after_literal = True
+            continue
+        is_regex = char == "/" and not text.startswith("/*", i) and starts_regex("".join(code), after_literal)
+        if char in ("'", '"') or is_regex:
+            pieces.append(" ".join("".join(code).split()))
+            end = literal_end(text, i)
+            pieces.append(text[i:end])
+            code = []
+            after_literal = True
+            i = end
+            continue
+        if char == "#":
+            while i < len(text) and text[i] != "\n":
+                i += 1
+            continue
+        if text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = len(text) if end == -1 else end + 2
+            continue
+        code.append(char)
+        i += 1
+    pieces.append(" ".join("".join(code).split()))
+    return " ".join(piece for piece in pieces if piece)
+
+# @(TAG), @("TAG") or @(TAG:syntax/escapes)
+HEREDOC_START = re.compile(r'@\(\s*"?([^":/)\s]+)"?\s*(?:[:/][^)]*)?\)')
+
+def heredoc_end(text, start, tags):
+    # the index just past the end marker (`| TAG`, `-TAG` etc on a line of its own) of each heredoc in turn
+    for tag in tags:
+        end = re.compile(rf"^[ \t]*\|?[ \t]*-?[ \t]*{re.escape(tag)}[ \t]*$", re.MULTILINE).search(text, start)
+        if end is None:
+            return len(text)
+        start = end.end()
+    return start
+
+def starts_regex(code, after_literal):
+    # a / after an operator, bracket, comma or keyword (`=~ /x/`, `node /web/`, a case option) starts a regex, but
+    # after a value (`$total / 2`) it's a divide
+    before = code.rstrip()
+    if not before:
+        return not after_literal
+    return before[-1] in "~=(,[{}:;!" or re.search(r"\b(node|and|or|in|if|elsif|unless)$", before) is not None
+
+def literal_end(text, start):
+    # the index just past the end of the quoted string or regex starting at start, skipping escaped characters
+    delimiter = text[start]
+    i = start + 1
+    while i < len(text):
+        if text[i] == "\\":
+            i += 2
+            continue
+        if text[i] == delimiter:
+            return i + 1
+        i += 1
+    return len(text)
+
+def splice_doc_blocks(module, blocks):
+    # put each {"kind", "name", "comment"} block directly above the class/define it documents.  Raises ValueError if
+    # a block doesn't match exactly one definition, so the caller can fall back to something else.
+    lines = module.splitlines()
+    insertions = {}
+    for block in blocks:
+        pattern = re.compile(rf"^(\s*){re.escape(block['kind'])}\s+{re.escape(block['name'].strip())}(\s|\(|\{{|$)")
+        matches = [index for index, line in enumerate(lines) if pattern.match(line)]
+        if len(matches) != 1:
+            raise ValueError(f"Found {len(matches)} definitions for {block['kind']} {block['name']}")
+        indent = pattern.match(lines[matches[0]]).group(1)
+        comment = []
+        for line in block["comment"].strip("\n").splitlines():
+            line = line.rstrip()
+            if not line.lstrip().startswith("#"):
+                line = f"# {line}".rstrip()
+            comment.append(f"{indent}{line.lstrip()}")
+        insertions[matches[0]] = comment
+    if not insertions:
+        raise ValueError("No documentation blocks were given")
+
+    documented = []
+    for index, line in enumerate(lines):
+        documented.extend(insertions.get(index, []))
+        documented.append(line)
+    return "\n".join(documented) + "\n"
+
+def looks_like_puppet(text):
+    # a class, define or node declaration, or a resource (`package { 'nginx':`), at the start of a line
+    return re.search(r"^\s*(class|define|node)\s+[\w:]+|^\s*[\w:]+\s*\{\s*['\"$]", text, re.MULTILINE) is not None
+
+def spinner(text, color, quiet=False):
+    # several runs sharing one terminal can't all have a spinner, so quiet runs get a do-nothing stand-in
+    if quiet:
+        return nullcontext()
+    return yaspin(text=text, color=color)
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = round((len(values) - 1) * percent / 100)
+    return values[index]
@@ -1,4 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
 import prompts
+from gepetto.response import ChatResponse
+from helpers import looks_like_puppet, splice_doc_blocks
 
 def get_llm_thoughts(requirements, bot):
     messages = [
@@ -15,6 +18,20 @@ def get_llm_thoughts(requirements, bot):
     return response
 
 def create_module(requirements, llm_thoughts, bot):
+    messages = module_messages(requirements, llm_thoughts)
+    response = bot.chat(messages, temperature=0.1)
+    return response
+
+def create_module_candidates(requirements, llm_thoughts, bot, n):
+    # one request with `n` choices where the vendor supports it, otherwise n requests side by side.  Each parallel
+    # request is numbered so they aren't all answered from the same cache entry.
+    if hasattr(bot, "chat_candidates"):
+        return bot.chat_candidates(module_messages(requirements, llm_thoughts), n=n, temperature=0.7)
+    with ThreadPoolExecutor(max_workers=n) as executor:
+        futures = [executor.submit(bot.chat, module_messages(requirements, llm_thoughts, f"(This is attempt {index + 1} of {n}.)"), temperature=0.7) for index in range(n)]
+        return [future.result() for future in futures]
+
+def module_messages(requirements, llm_thoughts, note=""):
     messages = [
         {
             "role": "system",
@@ -22,11 +39,10 @@ def create_module(requirements, llm_thoughts, bot):
         },
         {
             "role": "user",
-            "content": f"Hi! I would like you to create a puppet module for the following requirements:\n\n{requirements}\n\nPlease take into account the following thoughts:\n\n{llm_thoughts}"
+            "content": f"Hi! I would like you to create a puppet module for the following requirements:\n\n{requirements}\n\nPlease take into account the following thoughts:\n\n{llm_thoughts}{' ' + note if note else ''}"
         }
     ]
-    response = bot.chat(messages, temperature=0.1)
-    return response
+    return messages
 
 def document_module(module, bot):
     messages = [
@@ -42,7 +58,59 @@ def document_module(module, bot):
     response = bot.chat(messages, temperature=0.1)
     return response
 
-def create_test(requirements, module, llm_thoughts, bot):
+def document_module_in_blocks(module, bot):
+    # asking for just the doc comments and splicing them in locally saves the model re-writing the whole module.
+    # If the vendor can't do function calls or the blocks don't fit the module, fall back to a full rewrite.
+    messages = [
+        {
+            "role": "system",
+            "content": prompts.document_blocks_prompt
+        },
+        {
+            "role": "user",
+            "content": f"Hi! I would like you to write the puppet strings for the following puppet module:\n\n{module}"
+        }
+    ]
+    tools = [
+        {
+            "type": "function",
+            "function": {
+                "name": "add_puppet_strings",
+                "description": "Add Puppet Strings comments above the classes and defined types in a puppet module",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "blocks": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "kind": {"type": "string", "enum": ["class", "define"]},
+                                    "name": {"type": "string", "description": "The name of the class or defined type, eg apache::mod::php"},
+                                    "comment": {"type": "string", "description": "The Puppet Strings comment, every line starting with #"},
+                                },
+                                "required": ["kind", "name", "comment"],
+                            },
+                        },
+                    },
+                    "required": ["blocks"],
+                },
+            },
+        }
+    ]
+    try:
+        response = bot.function_call(messages, tools, temperature=0.1)
+    except NotImplementedError:
+        return document_module(module, bot)
+    try:
+        documented = splice_doc_blocks(module, response.parameters["blocks"])
+    except (KeyError, TypeError, ValueError):
+        fallback = document_module(module, bot)
+        return ChatResponse(fallback.message, fallback.tokens + response.tokens, fallback.cost + response.cost, fallback.model, fallback.cached_tokens + response.cached_tokens)
+    return ChatResponse(documented, response.tokens, response.cost, bot.model)
+
+def create_test(requirements, module, llm_thoughts, bot, distro=None):
+    distro_note = f"\n\nThe script will only be run on {distro}, so it can be specific to that distro." if distro else ""
     messages = [
         {
             "role": "system",
@@ -50,7 +118,23 @@ def create_test(requirements, module, llm_thoughts, bot):
         },
         {
             "role": "user",
-            "content": f"Hi! I would like you to create a python TestInfra script to test the results of the following puppet module:\n\n{module}\n\nPlease take into account the following original requirements and thoughts:\n\n{requirements}\n\n{llm_thoughts}"
+            "content": f"Hi! I would like you to create a python TestInfra script to test the results of the following puppet module:\n\n{module}\n\nPlease take into account the following original requirements and thoughts:\n\n{requirements}\n\n{llm_thoughts}{distro_note}"
+        }
+    ]
+    response = bot.chat(messages, temperature=0.1)
+    return response
+
+def repair_module(module, stage, output, bot, test_text=""):
+    # only the module and the tail of the failing output are sent - the requirements and thoughts aren't needed to fix it
+    test_note = f"\n\nThe TestInfra script which was run is:\n\n{test_text}" if test_text else ""
+    messages = [
+        {
+            "role": "system",
+            "content": prompts.repair_module_prompt
+        },
+        {
+            "role": "user",
+            "content": f"Hi! The following puppet module failed the {stage} check:\n\n{module}\n\nThe output of the check was:\n\n{output[-4000:]}{test_note}"
         }
     ]
     response = bot.chat(messages, temperature=0.1)
@@ -60,7 +144,7 @@ def create_filename(requirements, bot):
     messages = [
         {
             "role": "system",
-            "content": "You are a helpful AI assistant who is an expert with the Puppet system configuration system.  The user will provide you with the requirements they have for a new module, but they have difficulty thinking of a good filename which is Linux filesystem safe.  You should read the requirements and think of a concise filename.  Please resond with only the filename so that the user can copy and paste it easily."
+            "content": prompts.filename_prompt
         },
         {
             "role": "user",
@@ -70,3 +154,59 @@ def create_filename(requirements, bot):
     response = bot.chat(messages, temperature=0.1)
 
     return response
+
+def create_everything(requirements, bot):
+    # one function call which returns the thoughts, documented module, test script and filename together.  Raises
+    # NotImplementedError for vendors without function calling.
+    messages = [
+        {
+            "role": "system",
+            "content": prompts.single_call_prompt
+        },
+        {
+            "role": "user",
+            "content": f"Hi! I would like you to create a puppet module for the following requirements:\n\n{requirements}"
+        }
+    ]
+    fields = {
+        "thoughts": "Your thoughts on what to consider when writing the module",
+        "module": "The documented puppet module code",
+        "test_script": "The python TestInfra script which checks the module worked",
+        "filename": "A filesystem safe filename for the module",
+    }
+    tools = [
+        {
+            "type": "function",
+            "function": {
+                "name": "create_puppet_module",
+                "description": "Create a documented puppet module along with a TestInfra script to test it",
+                "parameters": {
+                    "type": "object",
+                    "properties": {name: {"type": "string", "description": description} for name, description in fields.items()},
+                    "required": list(fields),
+                },
+            },
+        }
+    ]
+    response = bot.function_call(messages, tools, temperature=0.1)
+    return response
+
+def check_everything(parameters):
+    # which of the fields from create_everything look usable
+    def text(name):
+        value = parameters.get(name)
+        return value.strip() if isinstance(value, str) else ""
+
+    module = text("module")
+    test_script = text("test_script")
+    try:
+        compile(test_script, "testinfra_script.py", "exec")
+        test_compiles = bool(test_script)
+    except (SyntaxError, ValueError):
+        test_compiles = False
+    return {
+        "thoughts": bool(text("thoughts")),
+        "module": looks_like_puppet(module),
+        "test_script": test_compiles and "testinfra" in test_script,
+        "filename": bool(text("filename")) and "\n" not in text("filename"),
+    }
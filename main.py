@@ -1,109 +1,623 @@
 import datetime
 import argparse
 import os
-from yaspin import yaspin
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+import prompts
 
 from gepetto import bot_factory, gpt
-from helpers import remove_markdown, sanitize_filename, save_file, create_output_directory, get_requirements, write_to_log, remove_previous_log
-from llm_steps import get_llm_thoughts, create_module, document_module, create_test, create_filename
-from docker_stuff import start_rocky_container, start_debian_container, tidy_up
-from steps import lint_module, test_module_runs, test_module_works
+from gepetto.cache import cache_stats
+from gepetto.hedging import hedge_stats
+from gepetto.limiter import scheduler_stats, set_rate_limit
+from gepetto.recorder import RecordingBot
+from gepetto.response import ChatResponse, FunctionResponse
+from helpers import remove_markdown, sanitize_filename, save_file, create_output_directory, get_requirements, write_to_log, remove_previous_log, spinner, strip_puppet_comments, looks_like_puppet
+from llm_steps import get_llm_thoughts, create_module, create_module_candidates, document_module, document_module_in_blocks, create_test, create_filename, create_everything, check_everything, repair_module
+from dag import Node, run_dag
+from docker_stuff import ContainerSession, wait_for_teardowns
+from steps import lint_module, lint_modules, test_module_runs, test_module_works, use_result_cache
+from run_state import MemoStore, RunState, new_run_id
+
+DISTROS = [("Rocky", 8), ("Debian", "bookworm")]
+# the stages whose answers should be a puppet module
+CODE_STAGES = ["module", "docs", "repair"]
 
-def main(model=gpt.Model.GPT_4_OMNI_0806.value[0], vendor="", requirements_file="", rebuild=False):
+def main(model=gpt.Model.GPT_4_OMNI_0806.value[0], vendor="", requirements_file="", rebuild=False, per_distro_tests=False, speculative=False, docs_mode="full", pipeline="multi", max_repairs=0, candidates=1, pool=None, cache=True, refresh=False, stage_models={}, stream=False, max_output_chars=0, rate_limits={}, hedge=None, hedge_after=None, resume="", memo=None, test_cache=True):
     create_output_directory()
 
-    requirements = get_requirements(requirements_file)
+    state = None
+    if resume:
+        # pick the run back up where it stopped, with its own requirements unless new ones are given
+        state = RunState(os.path.join("runs", resume))
+        requirements = get_requirements(requirements_file) if requirements_file else state.load_requirements()
+    else:
+        requirements = get_requirements(requirements_file)
     if not requirements:
         print("No requirements provided. Exiting.")
         exit(1)
 
-    start_time = datetime.datetime.now()
-    total_cost = 0
-    bot = bot_factory.get_bot(model=model, vendor=vendor)
-
-    remove_previous_log()
-
-    with yaspin(text="Thinking through requirements...", color="magenta") as spinner:
-        llm_thoughts = get_llm_thoughts(requirements, bot)
-        total_cost += llm_thoughts.cost
-        write_to_log("LLM Thoughts", llm_thoughts.message)
-
-    with yaspin(text="Creating module...", color="cyan") as spinner:
-        module = create_module(requirements, llm_thoughts.message, bot)
-        total_cost += module.cost
-        module_text = remove_markdown(module.message)
-        write_to_log("Generated Module", f"```\n{module_text}\n```")
-    with yaspin(text="Documenting module...", color="cyan") as spinner:
-        documented_module = document_module(module_text, bot)
-        total_cost += documented_module.cost
-        module_text = remove_markdown(documented_module.message)
-        write_to_log("Documented Module", f"```\n{module_text}\n```")
-
-    lint_in_container(module_text)
-
-    total_cost = test_in_container("Rocky", 8, requirements, module_text, llm_thoughts, bot, total_cost, rebuild)
-    total_cost = test_in_container("Debian", "bookworm", requirements, module_text, llm_thoughts, bot, total_cost, rebuild)
-
-    with yaspin(text="Creating filename...", color="red") as spinner:
-        filename = create_filename(requirements, bot)
-        total_cost += filename.cost
-    safe_filename = os.path.join("outputs", sanitize_filename(filename.message))
-    with yaspin(text=f"Saving module to {safe_filename}...", color="blue") as spinner:
-        save_file(module.message, safe_filename)
-
-    # remove temp files
-    os.remove("temp_module.pp")
-    # os.remove("testinfra_script.py")
-
-    end_time = datetime.datetime.now()
-    elapsed_time = (end_time - start_time).total_seconds()
+    for vendor_name, (requests_per_minute, tokens_per_minute) in rate_limits.items():
+        set_rate_limit(vendor_name, requests_per_minute, tokens_per_minute)
+    test_results = MemoStore(".test_cache") if test_cache else None
+    use_result_cache(test_results)
+    bots = bot_factory.get_stage_bots(model=model, vendor=vendor, stage_models=stage_models, cache=cache, refresh=refresh, stream=stream, abort_checks=get_abort_checks(max_output_chars), hedge=hedge, hedge_after=hedge_after)
+
+    run = run_pipeline(requirements, bots, rebuild=rebuild, per_distro_tests=per_distro_tests, speculative=speculative, docs_mode=docs_mode, pipeline=pipeline, max_repairs=max_repairs, candidates=candidates, pool=pool, state=state, memo=memo)
+
+    teardowns = wait_for_teardowns()
     print("\n\n")
-    print(f"Module saved to {safe_filename}")
-    print(f"Total time: {round(elapsed_time, 2)} seconds")
-    print(f"Total cost: ${round(total_cost, 5)}")
-    write_to_log("Stats", f"Total cost: ${round(total_cost, 5)} | Total time: {round(elapsed_time, 2)} seconds")
+    if run["passed"]:
+        print(f"Module saved to {run['filename']}")
+    else:
+        print(run["error"])
+    print(f"Total time: {round(run['elapsed'], 2)} seconds")
+    print(f"Total cost: ${round(run['cost'], 5)}")
+    if run["repairs"]:
+        print(f"Repairs: {run['repairs']} (cost: ${round(run['repair_cost'], 5)})")
+    for result in run["results"]:
+        print(f"  {result['distro']}: {'passed' if result['passed'] else 'failed'} (cost: ${round(result['cost'], 5)})")
+    print("Stages:")
+    for stage, tally in run["stages"].items():
+        if tally["calls"]:
+            print(f"  {stage} ({bots[stage].model}): {tally['calls']} calls, ${round(tally['cost'], 5)}, {round(tally['seconds'], 2)} seconds, {round(tally['cached_tokens'])} cached tokens")
+            if tally["streamed"]:
+                print(f"    first token after {round(tally['first_token_seconds'] / tally['streamed'], 2)} seconds on average, {tally['aborted']} aborted")
+    if cache:
+        print(f"LLM cache: {cache_stats(bots.values())}")
+    hedging = hedge_stats(bots.values())
+    if hedging:
+        print(f"Hedging: {hedging}")
+    for vendor_name, stats in scheduler_stats().items():
+        print(f"Rate limits ({vendor_name}): {stats}")
+    if memo is not None:
+        print(f"Pipeline memo: {memo.stats()}")
+    if test_results is not None:
+        print(f"Test cache: {test_results.stats()}")
+    teardown_time = sum(seconds for _, seconds in teardowns)
+    print(f"Container teardown: {round(teardown_time, 2)} seconds across {len(teardowns)} containers (in the background)")
+    write_to_log("Stats", f"Total cost: ${round(run['cost'], 5)} | Total time: {round(run['elapsed'], 2)} seconds" + (f" | LLM cache: {cache_stats(bots.values())}" if cache else ""))
     print("(Run log saved to log.md)")
+    if not run["passed"]:
+        print(f"(To pick up where this left off, run again with --resume {run['run_id']})")
+        exit(1)
 
-def lint_in_container(module_text):
-    with yaspin(text="Starting Linting Docker container...", color="green") as spinner:
-        container = start_rocky_container(version=8, minimal=False, rebuild=False)
-    with yaspin(text="Linting module...", color="yellow") as spinner:
-        exit_code, lint_output = lint_module(module_text, container)
-        if exit_code != 0:
-            print("Module failed linting. Exiting.")
-            print(module_text)
-            print(lint_output)
-            tidy_up(container)
-            exit(1)
-    with yaspin(text="Removing lint container...", color="red") as spinner:
-        tidy_up(container)
-    return True
-
-def test_in_container(container_type, version, requirements, module_text, llm_thoughts, bot, total_cost, rebuild):
-    with yaspin(text=f"Starting {container_type} Docker container...", color="green") as spinner:
-        if container_type == "Rocky":
-            container = start_rocky_container(version=version, minimal=False, rebuild=rebuild)
+def get_abort_checks(max_output_chars=0):
+    """Ways of spotting a streamed answer going wrong for each stage, so it can be cut off before it's all paid for.
+
+    A stage whose answer is cut off fails with StreamAborted rather than carrying on with half an answer.
+    """
+    def too_long(text):
+        return max_output_chars > 0 and len(text) > max_output_chars
+
+    def not_puppet(text):
+        # a module should have got to its first class, define or resource well before this.  Comments, like the
+        # Puppet Strings header the docs stage writes above the class, don't count.
+        code = "\n".join(line for line in text.splitlines() if not line.lstrip().startswith("#"))
+        return too_long(text) or (len(code) > 2000 and not looks_like_puppet(code[:2000]))
+
+    return {stage: not_puppet if stage in CODE_STAGES else too_long for stage in bot_factory.STAGES}
+
+def run_pipeline(requirements, bots, log_file="log.md", output_dir="outputs", rebuild=False, per_distro_tests=False, speculative=False, docs_mode="full", pipeline="multi", max_repairs=0, candidates=1, pool=None, container_slots=None, quiet=False, state=None, memo=None):
+    """Take one set of requirements all the way through to a tested module saved in output_dir.
+
+    bots is either one bot for everything or a {stage: bot} dict covering bot_factory.STAGES.  Failures are
+    recorded in the returned run rather than raised, so the cost spent so far isn't lost.  Each stage's output
+    is saved in state (a RunState, by default a new one under runs/) and any already saved there is reused.
+    The dag pipeline keeps its outputs in memo (a MemoStore, by default .pipeline_cache/) instead.
+    """
+    if state is None:
+        state = RunState(os.path.join("runs", new_run_id(requirements)))
+    state.save_requirements(requirements)
+    run = {"passed": False, "error": "", "cost": 0, "elapsed": 0, "filename": "", "module_text": "", "results": [], "repairs": 0, "repair_cost": 0, "run_id": state.run_id}
+    if not isinstance(bots, dict):
+        bots = {stage: bots for stage in bot_factory.STAGES}
+    # each stage keeps its own tally of calls, cost and time for this run
+    run["stages"] = {stage: {"calls": 0, "cost": 0, "cached_tokens": 0, "seconds": 0, "streamed": 0, "first_token_seconds": 0, "aborted": 0, "aborted_cost": 0} for stage in bot_factory.STAGES}
+    bots = {stage: RecordingBot(bot, run["stages"][stage]) for stage, bot in bots.items()}
+    settings = {
+        "log_file": log_file,
+        "output_dir": output_dir,
+        "rebuild": rebuild,
+        "per_distro_tests": per_distro_tests,
+        "speculative": speculative,
+        "docs_mode": docs_mode,
+        "pipeline": pipeline,
+        "max_repairs": max_repairs,
+        "candidates": candidates,
+        "pool": pool,
+        "container_slots": container_slots,
+        "quiet": quiet,
+        "state": state,
+        "memo": memo if memo is not None or pipeline != "dag" else MemoStore(),
+        # candidates still finishing off after another won, whose costs are added up at the end
+        "stragglers": [],
+    }
+    start_time = datetime.datetime.now()
+    remove_previous_log(log_file)
+    try:
+        generate_and_test(run, requirements, bots, settings)
+        run["passed"] = True
+    except Exception as e:
+        run["error"] = str(e)
+        write_to_log("Error", f"```\n{e}\n```", log_file)
+    for future in settings["stragglers"]:
+        if not future.cancelled() and future.exception() is None:
+            run["cost"] += future.result()["cost"]
+    # responses which were cut off never reached the stages that add up the cost, but they were still paid for
+    run["cost"] += sum(tally["aborted_cost"] for tally in run["stages"].values())
+    run["elapsed"] = (datetime.datetime.now() - start_time).total_seconds()
+    return run
+
+def generate_and_test(run, requirements, bots, settings):
+    # the images and containers are got ready in the background while the LLM does its thing.  container_slots
+    # caps how many runs can have containers up at once when several share a machine, so if there isn't a
+    # slot free yet the containers wait until the module has been written (or speculation needs them).
+    sessions = {container_type: ContainerSession(container_type.lower(), version, minimal=False, rebuild=settings["rebuild"], pool=settings["pool"], quiet=settings["quiet"]) for container_type, version in DISTROS}
+    container_slots = settings["container_slots"]
+    # speculation, candidate racing and the dag pipeline all use containers while writing the module, so they wait for a slot
+    needs_slot_now = settings["speculative"] or settings["candidates"] > 1 or settings["pipeline"] == "dag"
+    have_slot = container_slots is None or container_slots.acquire(blocking=needs_slot_now)
+    # the dag pipeline boots them once it has LLM work to wait on (see get_pipeline_nodes)
+    if have_slot and settings["pipeline"] != "dag":
+        for session in sessions.values():
+            session.start_in_background()
+    try:
+        if settings["pipeline"] == "dag":
+            run_pipeline_dag(run, requirements, bots, sessions, settings)
+            return
+        draft = write_module(run, requirements, bots, sessions, settings)
+        if not have_slot:
+            with spinner("Waiting for a free container slot...", "yellow", settings["quiet"]):
+                container_slots.acquire()
+                have_slot = True
+        check_module(run, requirements, bots, sessions, draft, settings)
+    finally:
+        for session in sessions.values():
+            session.close()
+        if container_slots is not None and have_slot:
+            container_slots.release()
+
+def get_pipeline_nodes(requirements, bots, sessions, settings):
+    # the multi-call pipeline as a DAG.  Each node is keyed on the prompt and model it uses (or the image it
+    # tests in) as well as its inputs, so only the nodes downstream of a change are run again.  The containers are
+    # booted in the background as soon as an LLM node has to run, so a run which is all memo hits boots none.
+    def llm_node(func):
+        def run(*args):
+            for session in sessions.values():
+                session.start_in_background()
+            return func(*args)
+        return run
+
+    documenter = get_documenter(settings)
+    docs_prompt = prompts.document_blocks_prompt if settings["docs_mode"] == "blocks" else prompts.document_module_prompt
+    nodes = [
+        Node("thoughts", llm_node(lambda: get_llm_thoughts(requirements, bots["thoughts"])), [], [requirements, prompts.initial_thoughts_prompt, bots["thoughts"].model]),
+        Node("module", llm_node(lambda thoughts: create_module(requirements, thoughts.message, bots["module"])), ["thoughts"], [requirements, prompts.write_module_prompt, bots["module"].model]),
+        Node("docs", llm_node(lambda module: documenter(remove_markdown(module.message), bots["docs"])), ["module"], [settings["docs_mode"], docs_prompt, bots["docs"].model]),
+        Node("lint", lambda docs: lint_node(remove_markdown(docs.message), sessions["Rocky"]), ["docs"], lambda: [sessions["Rocky"].image_id()]),
+        Node("test", llm_node(lambda thoughts, docs: create_test(requirements, remove_markdown(docs.message), thoughts.message, bots["test"])), ["thoughts", "docs"], [requirements, prompts.test_module_prompt, bots["test"].model]),
+        Node("filename", llm_node(lambda: create_filename(requirements, bots["filename"])), [], [requirements, prompts.filename_prompt, bots["filename"].model]),
+    ]
+    for container_type, session in sessions.items():
+        nodes.append(Node(
+            f"test_{container_type}",
+            lambda docs, test, lint, container_type=container_type, session=session: distro_test_node(container_type, session, requirements, remove_markdown(docs.message), test),
+            ["docs", "test", "lint"],
+            lambda session=session: [session.image_id()],
+        ))
+    return nodes
+
+def lint_node(module_text, session):
+    lint_in_container(module_text, session, quiet=True)
+    return {"passed": True}
+
+def distro_test_node(container_type, session, requirements, module_text, test):
+    shared_test = Future()
+    shared_test.set_result(test)
+    result = test_in_container(container_type, session, requirements, module_text, None, None, shared_test)
+    if not result["passed"]:
+        raise RuntimeError(result["output"])
+    return result
+
+def run_pipeline_dag(run, requirements, bots, sessions, settings):
+    log_file, quiet = settings["log_file"], settings["quiet"]
+    log_titles = {"thoughts": "LLM Thoughts", "module": "Generated Module", "docs": "Documented Module", "test": "TestInfra Script"}
+
+    def log_node(node, output, reused):
+        if node.name in log_titles:
+            message = output.message if node.name == "thoughts" else f"```\n{remove_markdown(output.message)}\n```"
+            write_to_log(log_titles[node.name] + (" (reused)" if reused else ""), message, log_file)
+
+    nodes = get_pipeline_nodes(requirements, bots, sessions, settings)
+    with spinner("Running the pipeline...", "cyan", quiet):
+        outcome = run_dag(nodes, settings["memo"], max_workers=len(nodes), on_finish=log_node)
+    outputs = outcome["outputs"]
+    run["cost"] += sum(getattr(outputs[name], "cost", 0) for name in outcome["ran"])
+    write_to_log("Pipeline", "\n".join(f"- {kind}: {', '.join(outcome[kind]) or 'nothing'}" for kind in ("reused", "ran", "skipped")), log_file)
+    if "docs" in outputs:
+        run["module_text"] = remove_markdown(outputs["docs"].message)
+
+    for container_type in sessions:
+        name = f"test_{container_type}"
+        if name in outputs:
+            result = dict(outputs[name], cost=0)
         else:
-            container = start_debian_container(version=version, minimal=False, rebuild=rebuild)
+            error = outcome["errors"].get(name, "Not tested, as an earlier stage failed")
+            result = {"distro": container_type, "passed": False, "exit_code": None, "output": str(error), "cost": 0, "test_text": ""}
+        write_to_log(f"{container_type} Test", f"Passed: {result['passed']}\n\n```\n{result['output']}\n```", log_file)
+        run["results"].append(result)
+    if outcome["errors"]:
+        report = "\n\n".join(f"{name}: {error}" for name, error in outcome["errors"].items())
+        raise RuntimeError(f"The pipeline failed at {', '.join(outcome['errors'])}\n{report}")
+
+    safe_filename = os.path.join(settings["output_dir"], sanitize_filename(outputs["filename"].message))
+    with spinner(f"Saving module to {safe_filename}...", "blue", quiet):
+        save_file(run["module_text"], safe_filename)
+    run["filename"] = safe_filename
+
+def write_module(run, requirements, bots, sessions, settings):
+    # the draft carries everything the checking stage needs: thoughts, module and (if already written) test and
+    # filename.  Anything saved by an earlier go at this run is used rather than asked for again.
+    log_file, quiet, state = settings["log_file"], settings["quiet"], settings["state"]
+    draft = None
+    if settings["pipeline"] == "single":
+        draft = write_module_in_one_call(run, requirements, bots["module"], settings)
+    if draft is None:
+        draft = {"thoughts": None, "module_text": "", "applied": set(), "linted": False, "test": None, "filename": None}
+
+    if draft["thoughts"] is None:
+        draft["thoughts"] = state.load("thoughts", requirements)
+    if draft["thoughts"] is None:
+        with spinner("Thinking through requirements...", "magenta", quiet):
+            draft["thoughts"] = get_llm_thoughts(requirements, bots["thoughts"])
+            run["cost"] += draft["thoughts"].cost
+        state.save("thoughts", draft["thoughts"], requirements)
+    write_to_log("LLM Thoughts", draft["thoughts"].message, log_file)
+
+    if not draft["module_text"]:
+        module = state.load("module", requirements, draft["thoughts"].message)
+        if module is None:
+            if settings["candidates"] > 1:
+                module_text, draft["test"] = race_candidates(run, requirements, bots, draft["thoughts"], settings)
+                module = ChatResponse(module_text, 0, 0, bots["module"].model)
+            else:
+                with spinner("Creating module...", "cyan", quiet):
+                    module = create_module(requirements, draft["thoughts"].message, bots["module"])
+                    run["cost"] += module.cost
+            state.save("module", module, requirements, draft["thoughts"].message)
+        raw_module_text = remove_markdown(module.message)
+        write_to_log("Generated Module", f"```\n{raw_module_text}\n```", log_file)
 
+        documented_module = state.load("docs", raw_module_text, settings["docs_mode"])
+        if documented_module is not None:
+            module_text = remove_markdown(documented_module.message)
+        elif settings["speculative"] and settings["candidates"] < 2:
+            documented_module, module_text, draft["applied"], draft["linted"] = document_speculatively(raw_module_text, bots["docs"], sessions, settings)
+        else:
+            with spinner("Documenting module...", "cyan", quiet):
+                documented_module = get_documenter(settings)(raw_module_text, bots["docs"])
+                module_text = remove_markdown(documented_module.message)
+        run["cost"] += documented_module.cost
+        state.save("docs", documented_module, raw_module_text, settings["docs_mode"])
+        draft["module_text"] = module_text
+    run["module_text"] = draft["module_text"]
+    write_to_log("Documented Module", f"```\n{draft['module_text']}\n```", log_file)
+    return draft
+
+def race_candidates(run, requirements, bots, llm_thoughts, settings):
+    # get several candidate modules, lint them all at once, then apply and test the survivors in their own Rocky
+    # containers.  The first one to pass wins and the rest are abandoned.
+    log_file, quiet = settings["log_file"], settings["quiet"]
+    with spinner(f"Creating {settings['candidates']} candidate modules...", "cyan", quiet):
+        candidates = create_module_candidates(requirements, llm_thoughts.message, bots["module"], settings["candidates"])
+        run["cost"] += sum(candidate.cost for candidate in candidates)
+        modules = [remove_markdown(candidate.message) for candidate in candidates]
+
+    rocky_version = dict(DISTROS)["Rocky"]
+    sessions = [ContainerSession("rocky", rocky_version, minimal=False, rebuild=settings["rebuild"], pool=settings["pool"], quiet=settings["quiet"]) for _ in modules]
+    for session in sessions:
+        session.start_in_background()
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=len(modules))
+    winner = None
     try:
-        with yaspin(text=f"Testing module runs in {container_type}...", color="green") as spinner:
-            exit_code, output = test_module_runs(module_text, container)
-            if exit_code != 0:
-                raise RuntimeError(f"Module failed to run with exit code {exit_code}\nOutput: {output}\nModule:\n{module_text}")
-
-        with yaspin(text=f"Testing module works in {container_type}...", color="green") as spinner:
-            testinfra = create_test(requirements, module_text, llm_thoughts.message, bot)
-            test_text = remove_markdown(testinfra.message)
-            total_cost += testinfra.cost
-            exit_code, output = test_module_works(module_text, test_text, container)
-            if exit_code != 0:
-                raise RuntimeError(f"Module failed its tests with exit code {exit_code}\nOutput: {output}\nModule:\n{module_text}\nTestInfra script:\n{test_text}")
+        with spinner("Linting candidate modules...", "yellow", quiet):
+            survivors = lint_modules(modules, sessions[0].start())
+        write_to_log("Candidates", f"{len(survivors)} of {len(modules)} candidates passed linting", log_file)
+        for index, session in enumerate(sessions):
+            if index not in survivors:
+                session.close()
+        if not survivors:
+            raise RuntimeError(f"None of the {len(modules)} candidate modules passed linting\nFirst candidate:\n{modules[0]}")
 
+        with spinner(f"Testing {len(survivors)} candidate modules...", "green", quiet):
+            futures = {executor.submit(try_candidate, modules[index], sessions[index], requirements, llm_thoughts, bots["test"], stop): index for index in survivors}
+            finished = set()
+            for future in as_completed(futures):
+                finished.add(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    write_to_log("Candidates", f"Candidate {futures[future] + 1} failed with an error: {e}", log_file)
+                    continue
+                run["cost"] += result["cost"]
+                if result["passed"]:
+                    winner = futures[future], result["test"]
+                    # the others may already have paid for a test, which is added to the cost once they stop
+                    settings["stragglers"].extend(other for other in futures if other not in finished)
+                    break
     finally:
-        tidy_up(container)
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        for session in sessions:
+            session.close()
+    if winner is None:
+        raise RuntimeError(f"None of the {len(modules)} candidate modules passed their tests\nFirst candidate:\n{modules[survivors[0]]}")
+    index, test = winner
+    write_to_log("Candidates", f"Candidate {index + 1} passed its tests first", log_file)
+    return modules[index], test
+
+def try_candidate(module_text, session, requirements, llm_thoughts, bot, stop):
+    result = {"passed": False, "cost": 0, "test": None}
+    try:
+        container = session.start()
+        if stop.is_set():
+            return result
+        exit_code, output = test_module_runs(module_text, container)
+        if exit_code != 0 or stop.is_set():
+            return result
+        test = create_test(requirements, module_text, llm_thoughts.message, bot)
+        result["cost"] += test.cost
+        if stop.is_set():
+            return result
+        exit_code, output = test_module_works(module_text, remove_markdown(test.message), container)
+        result["passed"] = exit_code == 0
+        result["test"] = test
+    except Exception:
+        # once another candidate has won, its container is pulled out from under this one
+        if not stop.is_set():
+            raise
+    return result
+
+def write_module_in_one_call(run, requirements, bot, settings):
+    # returns None if the vendor can't do it, otherwise a draft with any fields which failed their checks left
+    # empty so the usual steps can fill them in
+    state = settings["state"]
+    saved = state.load("single_call", requirements)
+    if saved is not None:
+        response = FunctionResponse(saved["parameters"], saved["tokens"], 0)
+    else:
+        with spinner("Writing module, tests and filename...", "cyan", settings["quiet"]):
+            try:
+                response = create_everything(requirements, bot)
+            except NotImplementedError:
+                return None
+        run["cost"] += response.cost
+        state.save("single_call", {"parameters": response.parameters, "tokens": response.tokens}, requirements)
+    parameters = response.parameters
+    checks = check_everything(parameters)
+    write_to_log("Single Call", "\n".join(f"- {field}: {'ok' if ok else 'failed its checks'}" for field, ok in checks.items()), settings["log_file"])
+
+    draft = {"thoughts": None, "module_text": "", "applied": set(), "linted": False, "test": None, "filename": None}
+    if checks["thoughts"]:
+        draft["thoughts"] = ChatResponse(parameters["thoughts"], response.tokens, response.cost, bot.model)
+    if checks["module"]:
+        draft["module_text"] = remove_markdown(parameters["module"])
+        # a test written against a module we've thrown away isn't much use
+        if checks["test_script"]:
+            draft["test"] = ChatResponse(remove_markdown(parameters["test_script"]), 0, 0, bot.model)
+    if checks["filename"]:
+        draft["filename"] = ChatResponse(parameters["filename"].strip(), 0, 0, bot.model)
+    return draft
+
+def document_speculatively(module_text, bot, sessions, settings):
+    # lint the raw module (cheap) before paying for documentation, then `puppet apply` it in every distro while
+    # the documentation is written.  If documenting didn't change the code, those apply results still stand.
+    # With repairs on, a failure is handed back to check_module's repair loop (not linted, nothing applied)
+    # rather than raised.  Returns the documented response and text, the distros applied in, and whether it linted.
+    log_file, quiet = settings["log_file"], settings["quiet"]
+    can_repair = settings["max_repairs"] > 0
+    with spinner("Linting undocumented module...", "yellow", quiet):
+        lint_output = lint_in_container(module_text, sessions["Rocky"], quiet=True, raise_on_failure=not can_repair)
+    if lint_output is not None:
+        write_to_log("Speculative Apply", "The undocumented module failed linting, so it will be documented and then repaired", log_file)
+        with spinner("Documenting module...", "cyan", quiet):
+            documented_module = get_documenter(settings)(module_text, bot)
+        return documented_module, remove_markdown(documented_module.message), set(), False
+
+    apply_failed = False
+    executor = ThreadPoolExecutor(max_workers=len(sessions) + 1)
+    try:
+        with spinner("Documenting module and test-applying the undocumented one...", "cyan", quiet):
+            documenting = executor.submit(get_documenter(settings), module_text, bot)
+            applies = {container_type: executor.submit(apply_in_session, module_text, session) for container_type, session in sessions.items()}
+            for container_type, future in applies.items():
+                exit_code, output = future.result()
+                write_to_log(f"{container_type} Speculative Apply", f"Exit code: {exit_code}\n\n```\n{output}\n```", log_file)
+                if exit_code != 0:
+                    if not can_repair:
+                        raise RuntimeError(f"Module failed to run in {container_type} with exit code {exit_code}\nOutput: {output}\nModule:\n{module_text}")
+                    apply_failed = True
+            documented_module = documenting.result()
+    finally:
+        executor.shutdown(wait=False)
+    documented_text = remove_markdown(documented_module.message)
+
+    with spinner("Linting documented module...", "yellow", quiet):
+        lint_output = lint_in_container(documented_text, sessions["Rocky"], quiet=True, raise_on_failure=not can_repair)
+    if not apply_failed and lint_output is None and strip_puppet_comments(documented_text) == strip_puppet_comments(module_text):
+        return documented_module, documented_text, set(sessions), True
+
+    # the apply results are void (the code changed, or it's going to be repaired) and the containers are dirty
+    if apply_failed:
+        write_to_log("Speculative Apply", "The undocumented module failed to apply, so it will be repaired in fresh containers", log_file)
+    elif lint_output is not None:
+        write_to_log("Speculative Apply", "The documented module failed linting, so it will be repaired in fresh containers", log_file)
+    else:
+        write_to_log("Speculative Apply", "Documenting the module changed its code, so it will be applied again in fresh containers", log_file)
+    for session in sessions.values():
+        session.close()
+        session.start_in_background()
+    return documented_module, documented_text, set(), lint_output is None
+
+def get_documenter(settings):
+    if settings["docs_mode"] == "blocks":
+        return document_module_in_blocks
+    return document_module
+
+def apply_in_session(module_text, session):
+    return test_module_runs(module_text, session.start())
+
+def check_module(run, requirements, bots, sessions, draft, settings):
+    # failures are sent back to the LLM to fix, up to max_repairs times, and re-checked in the same containers.
+    # Lint and test results are saved against the module (and test) they were for, so a resumed run only
+    # re-checks what didn't pass last time.
+    log_file, quiet, state = settings["log_file"], settings["quiet"], settings["state"]
+    module_text = draft["module_text"]
+    linted, applied, test = draft["linted"], draft["applied"], draft["test"]
+    repaired = state.load("repair", draft["module_text"])
+    if repaired is not None:
+        module_text = repaired.message
+        run["module_text"] = module_text
+        write_to_log("Resumed Repair", f"```\n{module_text}\n```", log_file)
+    if test is None:
+        test = state.load("test", requirements, draft["module_text"])
+    repairs_left = settings["max_repairs"]
+    try:
+        while True:
+            if not linted and not state.load("lint", module_text):
+                lint_output = lint_in_container(module_text, sessions["Rocky"], quiet, raise_on_failure=repairs_left < 1)
+                if lint_output is not None:
+                    module_text = repair(run, module_text, "lint", lint_output, bots["repair"], settings)
+                    state.save("repair", ChatResponse(module_text, 0, 0, bots["repair"].model), draft["module_text"])
+                    repairs_left -= 1
+                    continue
+            state.save("lint", True, module_text)
+
+            test_text = remove_markdown(test.message) if test else ""
+            saved_results = {container_type: state.load(f"test_{container_type}", module_text, test_text) for container_type in sessions}
+            results = [dict(result, cost=0) for result in saved_results.values() if result is not None and result["passed"]]
+            pending = {container_type: session for container_type, session in sessions.items() if container_type not in [result["distro"] for result in results]}
+            if pending:
+                with spinner(f"Testing module in {', '.join(pending)}...", "green", quiet):
+                    new_results, testinfra = test_in_distros(pending, requirements, module_text, draft["thoughts"], bots["test"], settings["per_distro_tests"], applied, test)
+                if testinfra and test is None:
+                    run["cost"] += testinfra.cost
+                    test = testinfra
+                    state.save("test", test, requirements, draft["module_text"])
+                    write_to_log("TestInfra Script", f"```\n{remove_markdown(testinfra.message)}\n```", log_file)
+                test_text = remove_markdown(test.message) if test else ""
+                for result in new_results:
+                    state.save(f"test_{result['distro']}", result, module_text, test_text)
+                results = sorted(results + new_results, key=lambda result: list(sessions).index(result["distro"]))
+            for result in results:
+                run["cost"] += result["cost"]
+                write_to_log(f"{result['distro']} Test", f"Passed: {result['passed']}\n\n```\n{result['output']}\n```", log_file)
+            run["results"] = results
+            failures = [result for result in results if not result["passed"]]
+            if not failures or repairs_left < 1:
+                break
+
+            report = "\n\n".join(f"{result['distro']}: {result['output'][-2000:]}" for result in failures)
+            module_text = repair(run, module_text, "apply/test", report, bots["repair"], settings, test_text)
+            state.save("repair", ChatResponse(module_text, 0, 0, bots["repair"].model), draft["module_text"])
+            repairs_left -= 1
+            linted, applied = False, set()
+    finally:
+        for session in sessions.values():
+            session.close()
+    if failures:
+        report = "\n\n".join(f"{result['distro']}: {result['output']}" for result in failures)
+        raise RuntimeError(f"Module failed in {len(failures)} of {len(results)} distros\n{report}\nModule:\n{module_text}")
+
+    filename = draft["filename"] or state.load("filename", requirements)
+    if filename is None:
+        with spinner("Creating filename...", "red", quiet):
+            filename = create_filename(requirements, bots["filename"])
+            run["cost"] += filename.cost
+        state.save("filename", filename, requirements)
+    safe_filename = os.path.join(settings["output_dir"], sanitize_filename(filename.message))
+    with spinner(f"Saving module to {safe_filename}...", "blue", quiet):
+        save_file(module_text, safe_filename)
+    run["filename"] = safe_filename
+
+def repair(run, module_text, stage, output, bot, settings, test_text=""):
+    with spinner(f"Repairing module after {stage} failure...", "magenta", settings["quiet"]):
+        response = repair_module(module_text, stage, output, bot, test_text)
+    run["repairs"] += 1
+    run["repair_cost"] += response.cost
+    run["cost"] += response.cost
+    module_text = remove_markdown(response.message)
+    run["module_text"] = module_text
+    write_to_log(f"Repair {run['repairs']} ({stage})", f"Output:\n\n```\n{output}\n```\n\nRepaired module:\n\n```\n{module_text}\n```", settings["log_file"])
+    return module_text
+
+def lint_in_container(module_text, session, quiet=False, raise_on_failure=True):
+    # the container is left running so the Rocky test stage can carry on using it.  Returns the lint output
+    # if the module failed and raise_on_failure is off, otherwise None.
+    with spinner("Starting Linting Docker container...", "green", quiet):
+        container = session.start()
+    with spinner("Linting module...", "yellow", quiet):
+        exit_code, lint_output = lint_module(module_text, container)
+        if exit_code != 0:
+            if raise_on_failure:
+                raise RuntimeError(f"Module failed linting\nOutput: {lint_output}\nModule:\n{module_text}")
+            return lint_output
+    return None
+
+def test_in_distros(sessions, requirements, module_text, llm_thoughts, bot, per_distro_tests=False, applied=set(), test=None):
+    # each distro gets its own container, so they can all be booted and tested at the same time.  Unless
+    # distro-specific tests are asked for, the TestInfra script is written once (if we don't already have
+    # one) while the containers boot.
+    results = []
+    with ThreadPoolExecutor(max_workers=len(sessions) + 1) as executor:
+        shared_test = None
+        if not per_distro_tests:
+            if test is not None:
+                shared_test = Future()
+                shared_test.set_result(test)
+            else:
+                shared_test = executor.submit(create_test, requirements, module_text, llm_thoughts.message, bot)
+        futures = {
+            executor.submit(test_in_container, container_type, session, requirements, module_text, llm_thoughts, bot, shared_test, container_type in applied): container_type
+            for container_type, session in sessions.items()
+        }
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({"distro": futures[future], "passed": False, "exit_code": None, "output": str(e), "cost": 0, "test_text": ""})
+        testinfra = shared_test.result() if shared_test and not shared_test.exception() else None
+    order = list(sessions)
+    return sorted(results, key=lambda result: order.index(result["distro"])), testinfra
+
+def test_in_container(container_type, session, requirements, module_text, llm_thoughts, bot, shared_test=None, already_applied=False):
+    # the container is left running in case a repaired module needs checking in it too
+    result = {"distro": container_type, "passed": False, "exit_code": None, "output": "", "cost": 0, "test_text": ""}
+    container = session.start()
+
+    if not already_applied:
+        exit_code, output = test_module_runs(module_text, container)
+        result["exit_code"], result["output"] = exit_code, output
+        if exit_code != 0:
+            result["output"] = f"Module failed to run with exit code {exit_code}\nOutput: {output}"
+            return result
 
-    return total_cost
+    if shared_test is not None:
+        testinfra = shared_test.result()
+    else:
+        testinfra = create_test(requirements, module_text, llm_thoughts.message, bot, distro=f"{container_type} {session.version}")
+        result["cost"] += testinfra.cost
+    test_text = remove_markdown(testinfra.message)
+    result["test_text"] = test_text
+    exit_code, output = test_module_works(module_text, test_text, container)
+    result["exit_code"], result["output"] = exit_code, output
+    if exit_code != 0:
+        result["output"] = f"Module failed its tests with exit code {exit_code}\nOutput: {output}\nTestInfra script:\n{test_text}"
+        return result
+    result["passed"] = True
+    return result
 
 if __name__ == "__main__":
     argp = argparse.ArgumentParser()
@@ -111,5 +625,23 @@ if __name__ == "__main__":
     argp.add_argument("--model", type=str, default=gpt.Model.GPT_4_OMNI_0806.value[0], help="The LLM model to use")
     argp.add_argument("--vendor", type=str, default="openai", help="The LLM vendor to use (not needed for openai/anthropic models)")
     argp.add_argument("--rebuild", action="store_true", help="Rebuild the Docker containers fresh")
+    argp.add_argument("--per-distro-tests", action="store_true", help="Write a separate TestInfra script for each distro")
+    argp.add_argument("--no-cache", action="store_true", help="Don't use or store cached LLM responses")
+    argp.add_argument("--refresh", action="store_true", help="Ignore cached LLM responses, but store the new ones")
+    argp.add_argument("--no-test-cache", action="store_true", help="Always run puppet apply and the TestInfra scripts, even if the same module and test passed in the same image before")
+    argp.add_argument("--speculative", action="store_true", help="Lint and apply the module while it is being documented")
+    argp.add_argument("--docs-mode", type=str, default="full", choices=["full", "blocks"], help="Have the LLM rewrite the whole module with documentation, or just write doc blocks to splice in")
+    argp.add_argument("--pipeline", type=str, default="multi", choices=["multi", "single", "dag"], help="Use a separate LLM call for each step, try to do them all in one call, or run the steps as a DAG which only re-runs what has changed since last time")
+    argp.add_argument("--max-repairs", type=int, default=0, help="How many times the LLM can try to fix a module which fails its checks")
+    argp.add_argument("--candidates", type=int, default=1, help="Create this many candidate modules and keep the first one to pass its tests")
+    argp.add_argument("--stage-model", type=str, action="append", default=[], help=f"Use a different model for one stage, as stage=model[@vendor] (stages: {', '.join(bot_factory.STAGES)}).  Can be given more than once")
+    argp.add_argument("--stage-config", type=str, default="", help="A JSON file mapping stages to models, as \"model[@vendor]\" or {\"model\": ..., \"vendor\": ...}")
+    argp.add_argument("--stream", action="store_true", help="Stream the LLM responses, timing them and cutting off any that go wrong")
+    argp.add_argument("--max-output-chars", type=int, default=0, help="When streaming, cut off any response longer than this")
+    argp.add_argument("--rate-limit", type=str, action="append", default=[], help="Hold a vendor to this many requests (and optionally tokens) a minute, as vendor=requests[/tokens].  Can be given more than once")
+    argp.add_argument("--resume", type=str, default="", help="Pick up a failed run where it left off, given the run id it printed")
+    argp.add_argument("--hedge", type=str, default="", help="If a chat is slow, race it against this model, as model[@vendor]")
+    argp.add_argument("--hedge-after", type=float, default=None, help="Seconds before a chat counts as slow (default: slower than 90%% of that stage's chats so far)")
     args = argp.parse_args()
-    main(model=args.model, vendor=args.vendor, requirements_file=args.requirements_file, rebuild=args.rebuild)
+    stage_models = bot_factory.get_stage_models(args.stage_model, args.stage_config, default_vendor=args.vendor)
+    main(model=args.model, vendor=args.vendor, requirements_file=args.requirements_file, rebuild=args.rebuild, per_distro_tests=args.per_distro_tests, speculative=args.speculative, docs_mode=args.docs_mode, pipeline=args.pipeline, max_repairs=args.max_repairs, candidates=args.candidates, cache=not args.no_cache, refresh=args.refresh, stage_models=stage_models, stream=args.stream, max_output_chars=args.max_output_chars, rate_limits=bot_factory.get_rate_limits(args.rate_limit), hedge=bot_factory.parse_stage_model(args.hedge, args.vendor) if args.hedge else None, hedge_after=args.hedge_after, resume=args.resume, memo=MemoStore(refresh=args.refresh) if args.pipeline == "dag" else None, test_cache=not args.no_test_cache)
@@ -0,0 +1,124 @@
+import datetime
+import hashlib
+import json
+import os
+import secrets
+import shutil
+import threading
+from gepetto.response import ChatResponse
+
+def encode_value(value):
+    # ChatResponses are saved field by field, anything else has to be JSON already
+    if isinstance(value, ChatResponse):
+        return {"chat_response": {"message": value.message, "tokens": value.tokens, "cost": value.cost, "model": value.model, "cached_tokens": value.cached_tokens}}
+    return {"value": value}
+
+def decode_value(saved):
+    # a saved response cost nothing this time round
+    if "chat_response" in saved:
+        response = saved["chat_response"]
+        return ChatResponse(response["message"], response["tokens"], 0, response["model"], response.get("cached_tokens", 0))
+    return saved.get("value")
+
+class RunState():
+    """The saved output of each stage of one run, so a failed run can be picked up where it left off.
+
+    Every stage's output is saved in `directory` along with a hash of its inputs.  Loading a stage only gives
+    the saved output back if it was made from the same inputs, so anything upstream of a change is redone.
+    Loaded responses cost nothing this time round.  Responses which were cut off aren't saved.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.run_id = os.path.basename(os.path.normpath(directory))
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, stage):
+        return os.path.join(self.directory, f"{stage}.json")
+
+    def inputs_hash(self, inputs):
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def save(self, stage, value, *inputs):
+        if getattr(value, "aborted", False):
+            # half an answer isn't a finished stage, so a resumed run asks again (as CachedBot does)
+            return
+        value = encode_value(value)
+        value["inputs_hash"] = self.inputs_hash(inputs)
+        # write then rename so a run killed part way through never leaves half a checkpoint
+        temp_path = f"{self.path(stage)}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(value, f)
+        os.replace(temp_path, self.path(stage))
+
+    def load(self, stage, *inputs):
+        """Get a stage's saved output, or None if there isn't one for these inputs."""
+        try:
+            with open(self.path(stage), "r") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if saved.get("inputs_hash") != self.inputs_hash(inputs):
+            return None
+        return decode_value(saved)
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def save_requirements(self, requirements):
+        with open(os.path.join(self.directory, "requirements.txt"), "w") as f:
+            f.write(requirements)
+
+    def load_requirements(self):
+        try:
+            with open(os.path.join(self.directory, "requirements.txt"), "r") as f:
+                return f.read()
+        except OSError:
+            return ""
+
+class MemoStore():
+    """Outputs saved by the hash of everything that went into them (see dag.py and steps.py), shared between runs.
+
+    Attributes:
+        hits (int): How many outputs were found.
+        misses (int): How many weren't.
+    """
+    def __init__(self, directory=".pipeline_cache", refresh=False):
+        self.directory = directory
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        saved = None
+        if not self.refresh:
+            try:
+                with open(self.path(key), "r") as f:
+                    saved = json.load(f)
+            except (OSError, ValueError):
+                pass
+        with self.lock:
+            if saved is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return decode_value(saved) if saved is not None else None
+
+    def put(self, key, value):
+        temp_path = f"{self.path(key)}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(encode_value(value), f)
+        os.replace(temp_path, self.path(key))
+
+    def stats(self):
+        return f"{self.hits} hits, {self.misses} misses"
+
+def new_run_id(requirements):
+    # the random part keeps two runs of the same requirements started in the same second apart
+    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    return f"{timestamp}-{hashlib.sha256(requirements.encode('utf-8')).hexdigest()[:6]}-{secrets.token_hex(2)}"
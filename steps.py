@@ -1,27 +1,60 @@
-from docker_stuff import exec_in_container, copy_to_container
+import hashlib
+import json
+from docker_stuff import exec_in_container, get_image_digest, put_files
 
-def lint_module(module, container):
-    with open("temp_module.pp", "w") as f:
-        f.write(module)
+# a MemoStore for apply/test results, set by use_result_cache().  None means every check really runs.
+result_cache = None
+
+def use_result_cache(store):
+    global result_cache
+    result_cache = store
+
+def run_checked(container, files, command):
+    # the same files and command in the same image give the same result, so a passing one is kept and given
+    # back next time.  Failures are always run again, in case they were down to the container not the module.
+    if result_cache is None:
+        put_files(container, files, "/tmp/")
+        return exec_in_container(container, command)
+    file_hashes = {name: hashlib.sha256(text.encode("utf-8")).hexdigest() for name, text in files.items()}
+    key = hashlib.sha256(json.dumps([file_hashes, get_image_digest(container), command], sort_keys=True).encode("utf-8")).hexdigest()
+    saved = result_cache.get(key)
+    if saved is not None:
+        return saved["exit_code"], saved["output"]
+    put_files(container, files, "/tmp/")
+    exit_code, output = exec_in_container(container, command)
+    if exit_code == 0:
+        result_cache.put(key, {"exit_code": exit_code, "output": output})
+    return exit_code, output
 
-    copy_to_container(container, "temp_module.pp", "/tmp/")
+def lint_module(module, container):
+    put_files(container, {"temp_module.pp": module}, "/tmp/")
 
     exit_code, output = exec_in_container(container, "puppet parser validate /tmp/temp_module.pp")
     return exit_code, output
 
+def lint_modules(modules, container):
+    # validate several modules with one `puppet parser validate` call and return the indexes of the ones which passed.
+    # Any module named in the errors failed; the rest are checked again in case puppet gave up before reaching them.
+    files = {f"candidate_{index}.pp": module for index, module in enumerate(modules)}
+    put_files(container, files, "/tmp/")
+    unchecked = list(range(len(modules)))
+    passed = []
+    while unchecked:
+        paths = " ".join(f"/tmp/candidate_{index}.pp" for index in unchecked)
+        exit_code, output = exec_in_container(container, f"puppet parser validate {paths}")
+        if exit_code == 0:
+            return sorted(passed + unchecked)
+        failed = [index for index in unchecked if f"/tmp/candidate_{index}.pp" in output]
+        if not failed:
+            # can't tell which one it was, so blame the first rather than loop forever
+            failed = unchecked[:1]
+        passed.extend(index for index in unchecked if index < min(failed))
+        unchecked = [index for index in unchecked if index > min(failed) and index not in failed]
+    return sorted(passed)
+
 def test_module_runs(module, container):
-    with open("temp_module.pp", "w") as f:
-        f.write(module)
-    copy_to_container(container, "temp_module.pp", "/tmp/")
-    exit_code, output = exec_in_container(container, "puppet apply /tmp/temp_module.pp")
-    return exit_code, output
+    return run_checked(container, {"temp_module.pp": module}, "puppet apply /tmp/temp_module.pp")
 
 def test_module_works(module, infratest_code, container):
-    with open("temp_module.pp", "w") as f:
-        f.write(module)
-    copy_to_container(container, "temp_module.pp", "/tmp/")
-    with open("testinfra_script.py", "w") as f:
-        f.write(infratest_code)
-    copy_to_container(container, "testinfra_script.py", "/tmp/")
-    exit_code, output = exec_in_container(container, "puppet apply /tmp/temp_module.pp && python3 /tmp/testinfra_script.py")
-    return exit_code, output
+    files = {"temp_module.pp": module, "testinfra_script.py": infratest_code}
+    return run_checked(container, files, "puppet apply /tmp/temp_module.pp && python3 /tmp/testinfra_script.py")